@@ -1,20 +1,137 @@
-import io
+import json
+import multiprocessing
 import os
+import re
+import shutil
+import tempfile
 import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from PIL import Image
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 
+from batch import DecodePool, detect_many, iter_archive, iter_multipart
+from batching import MicroBatcher, QueueFull
+from cache import PredictionCache, fingerprint
+from inference import get_engine, letterbox_geometry, top_prediction, unletterbox
+from ingest import IngestError, decode_to, image_info, open_image, sha256_stream
+from jobs import DONE, FAILED, JobQueue
+import metrics
+from metrics import collect, record, registry, timed, timings
+from render import Renderer, copy_stream
+from tiling import detect_tiled, tile_views, tiled_variant
+
 # Load environment variables
 load_dotenv()
 
+# 10 MB upload limit per image; batch uploads get their own, larger limit
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+BATCH_MAX_CONTENT_LENGTH = int(float(os.getenv("BATCH_MAX_MB", "100")) * 1024 * 1024)
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "64"))
+
+
+class _Request(Request):
+    @property
+    def max_content_length(self):
+        if self.endpoint == "detect_batch":
+            return BATCH_MAX_CONTENT_LENGTH
+        return super().max_content_length
+
+
 app = Flask(__name__)
+app.request_class = _Request
 CORS(app, resources={r"/*": {"origins": "*"}})  # allow all origins for dev
 
-# 10 MB upload limit
-app.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024
+app.config["MAX_CONTENT_LENGTH"] = MAX_IMAGE_BYTES
+
+# Per-stage timings, /metrics and Server-Timing; PROFILE_TOKEN enables X-Profile sampling
+metrics.init_app(app, profile_token=os.getenv("PROFILE_TOKEN") or None)
+
+# Decode/preprocess pool for batch uploads; DECODE_WORKERS=0 decodes on threads instead
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+
+# How long a request waits for its forward pass before answering 504
+INFERENCE_TIMEOUT_S = float(os.getenv("INFERENCE_TIMEOUT_S", "30"))
+
+# Tiled inference for large frames so small lesions survive; TILE_MIN_SIDE=0 disables auto mode
+TILE_SIZE = int(os.getenv("TILE_SIZE", "1280"))
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", "0.2"))
+TILE_MIN_SIDE = int(os.getenv("TILE_MIN_SIDE", "2000"))
+TILE_NMS_IOU = float(os.getenv("TILE_NMS_IOU", "0.5"))
+
+# Started by create_app(), not at import: decode workers under spawn or
+# forkserver import this module as __mp_main__ and must not start their own
+engine = decode_pool = batcher = cache = renderer = jobs = None
+
+def _new_decode_pool():
+    if DECODE_WORKERS > 0:
+        # Workers come from a clean forkserver (or spawn), never a fork of
+        # this already multi-threaded process
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        return ProcessPoolExecutor(max_workers=DECODE_WORKERS, mp_context=context)
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="decode")
+
+def create_app():
+    """Load the model and start the workers, once per process; returns the app.
+
+    ``python app.py`` calls it; WSGI servers should too, e.g.
+    ``waitress-serve --call app:create_app``.
+    """
+    global engine, decode_pool, batcher, cache, renderer, jobs
+    if engine is not None:
+        return app
+
+    # Load and warm up the model before the first request
+    engine = get_engine()
+
+    # Rebuilt if a worker process dies; workers start on the first batch upload
+    decode_pool = DecodePool(_new_decode_pool)
+
+    # Concurrent requests share batched forward passes; BATCH_MAX_SIZE=1 disables batching
+    batcher = MicroBatcher(
+        engine.predict_batch,
+        max_batch=int(os.getenv("BATCH_MAX_SIZE", "8")),
+        max_wait_ms=float(os.getenv("BATCH_MAX_WAIT_MS", "5")),
+        max_queue=int(os.getenv("BATCH_QUEUE_DEPTH", "64")),
+    ).start()
+
+    # Results for repeated uploads; CACHE_MAX_ENTRIES=0 disables, CACHE_DIR adds a disk
+    # tier bounded by CACHE_DISK_MAX_MB. CACHE_PHASH=1 also serves re-encoded or
+    # resized copies of a cached image (near duplicates); it is off by default
+    # because a wrong near hit returns another leaf's diagnosis.
+    cache = PredictionCache(
+        engine.model_version,
+        max_entries=int(os.getenv("CACHE_MAX_ENTRIES", "1024")),
+        max_bytes=int(float(os.getenv("CACHE_MAX_MB", "64")) * 1024 * 1024),
+        ttl_s=float(os.getenv("CACHE_TTL_S", "86400")),
+        disk_dir=os.getenv("CACHE_DIR") or None,
+        disk_max_bytes=int(float(os.getenv("CACHE_DISK_MAX_MB", "256")) * 1024 * 1024),
+        phash=os.getenv("CACHE_PHASH", "0") == "1",
+        phash_distance=int(os.getenv("CACHE_PHASH_DISTANCE", "64")),
+        thumb_tolerance=int(os.getenv("CACHE_THUMB_TOLERANCE", "8")),
+    )
+
+    # Annotated images are drawn lazily on first GET and cached on disk
+    renderer = Renderer(
+        os.getenv("RENDER_DIR") or os.path.join(tempfile.gettempdir(), "calasense-render"),
+        max_bytes=int(float(os.getenv("RENDER_CACHE_MB", "256")) * 1024 * 1024),
+        source_max_bytes=int(float(os.getenv("RENDER_SOURCE_MB", "512")) * 1024 * 1024),
+    )
+
+    # Async jobs; results are kept JOB_TTL_S after they finish
+    jobs = JobQueue(
+        _run_job,
+        workers=int(os.getenv("JOB_WORKERS", "2")),
+        max_pending=int(os.getenv("JOB_QUEUE_DEPTH", "32")),
+        ttl_s=float(os.getenv("JOB_TTL_S", "3600")),
+        spool_dir=os.getenv("JOB_SPOOL_DIR") or None,
+    ).start()
+    return app
+
+ANNOTATED_ID = re.compile(r"^[0-9a-f]{64}-[0-9a-f]{16}$")
 
 # --- Helpers ---
 ALLOWED_EXT = {"jpg", "jpeg", "png", "bmp", "webp"}
@@ -36,63 +153,356 @@ def version():
     return jsonify(
         api="calasense-flask",
         version="0.1.0",
-        model_loaded=False,  # will change to True when YOLO added
+        model_loaded=engine.loaded,
+        backend=engine.backend_name,
+        model_version=engine.model_version,
+        load_ms=round(engine.load_ms, 1),
+        warmup_ms=round(engine.warmup_ms, 1) if engine.warmup_ms is not None else None,
         time=_now_iso()
     )
 
-@app.post("/predict")
-def predict():
-    """Accepts image upload and returns dummy result for now"""
-    if "image" not in request.files:
-        return jsonify(error="No file part 'image' found"), 400
+def _read_image():
+    """Validate the 'image' upload from its header; returns (upload, None) or (None, error response)
 
-    file = request.files["image"]
+    The image is opened lazily: nothing is decoded until _run_detection needs
+    pixels, and cache hits never decode at all.
+    """
+    with timed("upload"):
+        files = request.files
+    if "image" not in files:
+        return None, (jsonify(error="No file part 'image' found"), 400)
+
+    file = files["image"]
 
     if file.filename == "":
-        return jsonify(error="No selected file"), 400
+        return None, (jsonify(error="No selected file"), 400)
     if not _allowed(file.filename):
-        return jsonify(error="Unsupported file type"), 415
+        return None, (jsonify(error="Unsupported file type"), 415)
 
-    # Verify it’s an image
+    # Hash the spooled upload in chunks instead of reading it into one buffer
+    with timed("hash"):
+        digest = sha256_stream(file.stream)
     try:
-        image_bytes = file.read()
-        img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    except Exception as e:
-        return jsonify(error=f"Invalid image: {e}"), 400
-
-    # Dummy prediction for now
-    start = time.time()
-    time.sleep(0.15)  # simulate inference time
-    dummy = {
-        "class": "Leaf Blight",   # replace later with YOLO output
-        "confidence": 0.87,
+        with timed("header"):
+            img = open_image(file.stream)
+    except IngestError as e:
+        return None, (jsonify(error=str(e)), e.status)
+    return {"digest": digest, "image": img, **image_info(img)}, None
+
+def _use_tiling(upload, flag):
+    """tiled=1/0 forces the mode; otherwise tile when the long side reaches TILE_MIN_SIDE"""
+    flag = (flag or "auto").lower()
+    if flag in ("1", "true", "yes"):
+        return True
+    if flag in ("0", "false", "no"):
+        return False
+    return TILE_MIN_SIDE > 0 and max(upload["width"], upload["height"]) >= TILE_MIN_SIDE
+
+def _run_detection(upload, tiled_flag="auto"):
+    """Runs the model on one image unless cached; returns (detections, elapsed_ms, cache status, tiles)"""
+    start = time.perf_counter()
+    width, height = upload["width"], upload["height"]
+    tiled = _use_tiling(upload, tiled_flag)
+    variant = tiled_variant(TILE_SIZE, TILE_OVERLAP) if tiled else ""
+    key = cache.key(upload["digest"], variant)
+    with timed("cache"):
+        hit = cache.get(key)
+    if hit is not None:
+        return hit["detections"], int((time.perf_counter() - start) * 1000), "hit", 0
+
+    if tiled:
+        with timed("decode"):
+            views = tile_views(upload["image"], width, height, engine.imgsz,
+                               tile=TILE_SIZE, overlap=TILE_OVERLAP)
+        x, content = views["full_view"], views["content"]
+    else:
+        with timed("decode"):
+            new_w, new_h, _, _ = letterbox_geometry(width, height, engine.imgsz)
+            content = decode_to(upload["image"], (new_w, new_h))
+        with timed("preprocess"):
+            x = engine.preprocess(content)
+
+    # Re-encoded or resized copies of a cached image, checked before any inference
+    fp = None
+    if cache.enabled and cache.phash:
+        with timed("phash"):
+            fp = fingerprint(content)
+        hit = cache.get_similar(fp, width, height, variant)
+        if hit is not None:
+            return hit["detections"], int((time.perf_counter() - start) * 1000), "near_hit", 0
+
+    if tiled:
+        n_tiles = len(views["crops"])
+        # More views than the queue holds go through in batch-sized chunks instead
+        chunk = None if n_tiles + 1 <= batcher.max_queue else min(batcher.max_batch, batcher.max_queue)
+        with timed("tiled"):
+            dets = detect_tiled(views, width, height, engine.imgsz, batcher.submit_many,
+                                iou_threshold=TILE_NMS_IOU, timeout=INFERENCE_TIMEOUT_S, chunk=chunk)
+    else:
+        future = batcher.submit(x)
+        try:
+            dets = future.result(timeout=INFERENCE_TIMEOUT_S)
+        except TimeoutError:
+            future.cancel()  # still queued: don't run the model for a request that has gone
+            raise
+        record("queue", future.queue_wait_s)
+        record("inference", future.forward_s)
+        dets = unletterbox(dets, width, height, engine.imgsz)
+        n_tiles = 0
+
+    cache.miss()
+    with timed("cache"):
+        cache.put(key, dets, width, height, fp, variant)
+    elapsed_ms = int((time.perf_counter() - start) * 1000)
+    return dets, elapsed_ms, "miss" if cache.enabled else "off", n_tiles
+
+def _busy(status=503, retry_after=1):
+    resp = jsonify(error="Server busy, try again shortly")
+    resp.headers["Retry-After"] = str(retry_after)
+    return resp, status
+
+def _meta(upload, elapsed_ms, cache_status, n_tiles):
+    """Response meta block. Its timings are taken before the body is serialised,
+    so the serialize stage only shows up in Server-Timing and /metrics."""
+    return {
+        "inference_ms": elapsed_ms,
+        "cache": cache_status,
+        "tiles": n_tiles,
+        "width": upload["width"],
+        "height": upload["height"],
+        "format": upload["format"],
+        "backend": engine.backend_name,
+        "model_version": engine.model_version,
+        "timings": timings(),
+        "timestamp": _now_iso(),
     }
-    elapsed_ms = int((time.time() - start) * 1000)
 
-    return jsonify(
-        ok=True,
-        prediction=dummy,
-        meta={
-            "inference_ms": elapsed_ms,
-            "width": img.width,
-            "height": img.height,
-            "timestamp": _now_iso(),
+def _run_job(job):
+    """Job worker: same pipeline as /detect on the spooled upload"""
+    with collect(), open(job.path, "rb") as f:
+        img = open_image(f)
+        upload = {"digest": job.options["digest"], "image": img, **image_info(img)}
+        # Job workers can afford to wait for room in the inference queue
+        deadline = time.monotonic() + INFERENCE_TIMEOUT_S
+        while True:
+            try:
+                dets, elapsed_ms, cache_status, n_tiles = _run_detection(upload, job.options.get("tiled"))
+                break
+            except QueueFull:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        annotated_id = renderer.register(upload["digest"], dets, lambda path: shutil.copyfile(job.path, path))
+        return {
+            "ok": True,
+            "detections": dets,
+            "annotated_url": f"/annotated/{annotated_id}.jpg",
+            "meta": _meta(upload, elapsed_ms, cache_status, n_tiles),
         }
-    )
 
+SSE_KEEPALIVE_S = 15
+
+@app.get("/stats")
+def stats():
+    return jsonify(batching=batcher.stats(), cache=cache.stats(), jobs=jobs.stats(),
+                   render=renderer.stats(),
+                   decode={"workers": DECODE_WORKERS, "restarts": decode_pool.restarts},
+                   time=_now_iso())
+
+# Queue and cache state, read at scrape time
+registry.callback("calasense_inference_queue_depth", "Images waiting for a forward pass",
+                  lambda: batcher.queue_depth)
+registry.callback("calasense_inference_batches_total", "Forward passes by batch size",
+                  lambda: {(k,): v for k, v in batcher.stats()["batch_sizes"].items()},
+                  ("size",), kind="counter")
+registry.callback("calasense_job_queue_depth", "Async jobs waiting for a worker",
+                  lambda: jobs.stats()["queue_depth"])
+registry.callback("calasense_cache_events_total", "Prediction cache lookups and evictions",
+                  lambda: {(k,): v for k, v in cache.stats().items()
+                           if k in ("hits", "near_hits", "disk_hits", "misses", "evictions", "expirations",
+                                    "disk_evictions")},
+                  ("event",), kind="counter")
+registry.callback("calasense_cache_entries", "Entries in the in-memory prediction cache",
+                  lambda: cache.stats()["entries"])
+registry.callback("calasense_model_warmup_seconds", "Model warm-up time at startup",
+                  lambda: engine.warmup_ms / 1000 if engine.warmup_ms is not None else None)
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.get("/profiles/<profile_id>")
+def get_profile(profile_id):
+    """Folded stacks of a request profiled with X-Profile (flamegraph.pl / speedscope input)"""
+    folded = metrics.profiles.get(profile_id)
+    if folded is None:
+        return jsonify(error="Unknown or expired profile"), 404
+    return Response(folded, mimetype="text/plain")
+
+@app.post("/jobs")
+def create_job():
+    """Accepts image upload, queues detection and returns a job id immediately"""
+    upload, err = _read_image()
+    if err:
+        return err
+
+    file = request.files["image"]
+
+    def save(path):
+        file.stream.seek(0)
+        file.save(path)
+
+    options = {"digest": upload["digest"], "tiled": request.args.get("tiled")}
+    key = request.headers.get("Idempotency-Key") or None
+    try:
+        job, created = jobs.submit(save, options, idempotency_key=key)
+    except QueueFull:
+        return _busy(429, jobs.retry_after())
+
+    if not created and job.options["digest"] != upload["digest"]:
+        return jsonify(error="Idempotency-Key was already used for a different upload"), 422
+
+    body = {
+        **job.to_dict(),
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events",
+    }
+    resp = jsonify(body)
+    resp.headers["Location"] = body["status_url"]
+    return resp, 202 if created else 200
+
+@app.get("/jobs/<job_id>")
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown or expired job"), 404
+    return jsonify(job.to_dict())
+
+@app.get("/jobs/<job_id>/events")
+def job_events(job_id):
+    """Server-Sent Events: current status now, then one final event on completion"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown or expired job"), 404
+
+    def events():
+        yield f"event: status\ndata: {json.dumps({'job_id': job.id, 'status': job.status})}\n\n"
+        while not job.done.wait(SSE_KEEPALIVE_S):
+            yield ": keep-alive\n\n"
+        event = "done" if job.status == DONE else "failed" if job.status == FAILED else "status"
+        yield f"event: {event}\ndata: {json.dumps(job.to_dict())}\n\n"
+
+    resp = Response(events(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # stop proxies from buffering the stream
+    return resp
+
+@app.post("/detect/batch")
+def detect_batch():
+    """Accepts many images ('images' files or a zip 'archive') and streams NDJSON results
+
+    Images are tiled exactly as on /detect (including ?tiled=), so both routes
+    give the same boxes and share cache entries.
+    """
+    if "archive" in request.files:
+        try:
+            archive = zipfile.ZipFile(request.files["archive"].stream)
+        except zipfile.BadZipFile:
+            return jsonify(error="Invalid archive"), 400
+        sources = iter_archive(archive, _allowed, BATCH_MAX_IMAGES, MAX_IMAGE_BYTES)
+    else:
+        files = request.files.getlist("images") + request.files.getlist("image")
+        if not files:
+            return jsonify(error="No files in 'images' or 'archive'"), 400
+        sources = iter_multipart(files, _allowed, BATCH_MAX_IMAGES, MAX_IMAGE_BYTES)
+
+    flag = request.args.get("tiled")
+    results = detect_many(sources, decode_pool, batcher, cache, engine.imgsz,
+                          timeout=INFERENCE_TIMEOUT_S, max_inflight=2 * max(1, DECODE_WORKERS),
+                          use_tiling=lambda info: _use_tiling(info, flag), tile=TILE_SIZE,
+                          overlap=TILE_OVERLAP, iou_threshold=TILE_NMS_IOU)
+
+    def ndjson():
+        try:
+            for result in results:
+                yield json.dumps(result, separators=(",", ":")) + "\n"
+        finally:
+            results.close()  # client gone: cancel the images that have not started
+
+    return Response(stream_with_context(ndjson()), mimetype="application/x-ndjson")
+
+@app.post("/predict")
+def predict():
+    """Accepts image upload and returns the top predicted class"""
+    upload, err = _read_image()
+    if err:
+        return err
+
+    try:
+        dets, elapsed_ms, cache_status, n_tiles = _run_detection(upload, request.args.get("tiled"))
+    except IngestError as e:
+        return jsonify(error=str(e)), e.status
+    except QueueFull:
+        return _busy()
+    except TimeoutError:
+        return jsonify(error="Inference timed out, try again shortly"), 504
+
+    meta = _meta(upload, elapsed_ms, cache_status, n_tiles)
+    with timed("serialize"):
+        return jsonify(ok=True, prediction=top_prediction(dets), meta=meta)
+
+@app.post("/detect")
+def detect():
+    """Accepts image upload and returns every detected box"""
+    upload, err = _read_image()
+    if err:
+        return err
+
+    try:
+        dets, elapsed_ms, cache_status, n_tiles = _run_detection(upload, request.args.get("tiled"))
+    except IngestError as e:
+        return jsonify(error=str(e)), e.status
+    except QueueFull:
+        return _busy()
+    except TimeoutError:
+        return jsonify(error="Inference timed out, try again shortly"), 504
+
+    with timed("store"):
+        annotated_id = renderer.register(upload["digest"], dets, copy_stream(request.files["image"].stream))
+
+    meta = _meta(upload, elapsed_ms, cache_status, n_tiles)
+    with timed("serialize"):
+        return jsonify(
+            ok=True,
+            detections=dets,
+            annotated_url=f"/annotated/{annotated_id}.jpg",
+            meta=meta,
+        )
+
+@app.get("/annotated/<annotated_id>.jpg")
+def annotated(annotated_id):
+    """Annotated JPEG for a /detect result; ?w= gives a thumbnail, ?q= the JPEG quality"""
+    if not ANNOTATED_ID.match(annotated_id):
+        return jsonify(error="Unknown annotated image"), 404
+    # Parsed by hand: args.get(type=int) would silently ignore a bad value
+    try:
+        width = int(request.args["w"]) if "w" in request.args else None
+        quality = int(request.args.get("q", "85"))
+    except ValueError:
+        return jsonify(error="Invalid w or q"), 400
+    width = min(max(width, 16), 8192) if width else None
+    quality = min(max(quality, 30), 95)
 
-# --- Future YOLO integration example ---
-# from ultralytics import YOLO
-# model = YOLO("runs/train/weights/best.pt")
-#
-# def yolo_predict_pil(pil_img):
-#     results = model.predict(pil_img, imgsz=640, conf=0.25, verbose=False)[0]
-#     conf = max(results.probs.data.tolist())
-#     cls_idx = int(results.probs.top1)
-#     cls_name = model.names[cls_idx]
-#     return {"class": cls_name, "confidence": float(conf)}
+    with timed("render"):
+        path = renderer.get(annotated_id, width, quality)
+    if path is None:
+        return jsonify(error="Annotated image expired, run detection again"), 404
+    # Content-addressed, so the cache name is a strong ETag; send_file handles
+    # If-None-Match/If-Modified-Since (304) and Range (206)
+    etag = os.path.basename(path)[:-4]
+    return send_file(path, mimetype="image/jpeg", conditional=True, etag=etag, max_age=86400)
 
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "5000"))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    create_app().run(host="0.0.0.0", port=port, debug=True)
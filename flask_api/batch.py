@@ -0,0 +1,346 @@
+"""Multi-image detection for ``POST /detect/batch``.
+
+Images come from a multipart request or a zip archive and are read lazily.
+Each one is decoded and preprocessed on a worker pool, then handed to the
+micro-batcher, and a result dict is yielded as soon as that image finishes.
+The route streams these dicts as NDJSON. At most ``max_inflight`` images are
+decoding or waiting for the model at once, so memory stays bounded however
+many the request holds. Large images are tiled as on ``/detect``. A bad image
+produces an error result for that image only. Each image's hash, decode,
+queue and inference times feed the stage histograms.
+"""
+import hashlib
+import io
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures.thread import BrokenThreadPool
+
+from batching import QueueFull
+from cache import fingerprint
+from inference import letterbox_geometry, unletterbox
+from ingest import IngestError, decode_bytes, image_info, open_image
+from metrics import record, timed
+from tiling import decode_tiles, detect_tiled, tiled_variant
+
+
+class DecodePool:
+    """Decode executor that is built on first use and replaces itself when it breaks.
+
+    A ProcessPoolExecutor is unusable for good once one of its worker
+    processes dies (OOM kill, codec crash): every later submit raises
+    BrokenProcessPool. ``factory()`` builds a fresh executor in that case.
+    Each future carries the executor it ran on as ``future.executor``.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._executor = None
+        self.restarts = 0
+
+    def submit(self, fn, *args):
+        executor = self._executor or self._start()
+        try:
+            future = executor.submit(fn, *args)
+        except (BrokenProcessPool, BrokenThreadPool):
+            executor = self.replace(executor)
+            future = executor.submit(fn, *args)
+        future.executor = executor
+        return future
+
+    def replace(self, broken):
+        """Swap ``broken`` for a new executor unless another caller already did."""
+        with self._lock:
+            if self._executor is broken:
+                self._executor = self.factory()
+                self.restarts += 1
+            executor = self._executor
+        broken.shutdown(wait=False, cancel_futures=True)
+        return executor
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    def _start(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = self.factory()
+            return self._executor
+
+
+def iter_multipart(files, allowed, max_images: int, max_file_bytes: int):
+    """Yield ``(name, read)`` for uploaded files; ``read()`` returns the bytes."""
+    for i, file in enumerate(files):
+        name = file.filename or f"image-{i}"
+        if i >= max_images:
+            yield name, _error(f"Batch is limited to {max_images} images", 413)
+        elif not allowed(name):
+            yield name, _error("Unsupported file type", 415)
+        elif file.content_length and file.content_length > max_file_bytes:
+            yield name, _error("Image too large", 413)
+        else:
+            yield name, _file_reader(file, max_file_bytes)
+
+
+def iter_archive(archive: zipfile.ZipFile, allowed, max_images: int, max_member_bytes: int):
+    """Yield ``(name, read)`` for image members of a zip archive.
+
+    Members are size-checked against their header and again while reading,
+    so a lying header can't inflate into an oversized buffer.
+    """
+    members = [m for m in archive.infolist()
+               if not m.is_dir() and not m.filename.rsplit("/", 1)[-1].startswith(".")]
+    for i, member in enumerate(members):
+        name = member.filename
+        if i >= max_images:
+            yield name, _error(f"Batch is limited to {max_images} images", 413)
+        elif not allowed(name):
+            yield name, _error("Unsupported file type", 415)
+        elif member.file_size > max_member_bytes:
+            yield name, _error("Image too large", 413)
+        else:
+            yield name, _member_reader(archive, member, max_member_bytes)
+
+
+def _read_limited(f, limit):
+    data = f.read(limit + 1)
+    if len(data) > limit:
+        raise IngestError("Image too large", 413)
+    return data
+
+
+def _file_reader(file, limit):
+    # Parts rarely declare a length, so the read itself is bounded too
+    return lambda: _read_limited(file.stream, limit)
+
+
+def _member_reader(archive, member, limit):
+    def read():
+        with archive.open(member) as f:
+            return _read_limited(f, limit)
+    return read
+
+
+def _error(message, status):
+    def read():
+        raise IngestError(message, status)
+    return read
+
+
+def _failure(index, name, e):
+    if isinstance(e, IngestError):
+        return {"index": index, "filename": name, "ok": False, "error": str(e), "status": e.status}
+    if isinstance(e, TimeoutError):
+        return {"index": index, "filename": name, "ok": False, "error": "Timed out", "status": 504}
+    if isinstance(e, QueueFull):
+        return {"index": index, "filename": name, "ok": False,
+                "error": "Server busy, try again shortly", "status": 503}
+    if isinstance(e, (BrokenProcessPool, BrokenThreadPool)):
+        return {"index": index, "filename": name, "ok": False,
+                "error": "Decode worker crashed, try again", "status": 503}
+    return {"index": index, "filename": name, "ok": False, "error": f"Detection failed: {e}", "status": 500}
+
+
+# Tiled images of one batch request running detect_tiled at once; each of
+# them already fills the inference queue with its views
+TILED_WORKERS = 2
+
+
+def _detect_tiled(item, batcher, imgsz, timeout, iou_threshold):
+    # Runs on a helper thread; like a job worker it waits for room in the queue
+    views = item.pop("views")
+    n_views = len(views["crops"]) + 1
+    chunk = None if n_views <= batcher.max_queue else min(batcher.max_batch, batcher.max_queue)
+    deadline = time.monotonic() + timeout
+    with timed("tiled"):
+        while True:
+            try:
+                return detect_tiled(views, item["width"], item["height"], imgsz, batcher.submit_many,
+                                    iou_threshold=iou_threshold,
+                                    timeout=max(0.0, deadline - time.monotonic()), chunk=chunk)
+            except QueueFull:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+
+def detect_many(sources, pool: DecodePool, batcher, cache, imgsz: int, timeout: float = 30.0,
+                max_inflight: int = 8, use_tiling=None, tile: int = 1280, overlap: float = 0.2,
+                iou_threshold: float = 0.5):
+    """Run detection over ``(name, read)`` sources, yielding results as they finish.
+
+    Yields one dict per image (``index``, ``filename``, ``ok`` and either
+    ``detections``/``meta`` or ``error``/``status``), in completion order,
+    then a final summary dict with ``done: True``.
+
+    ``use_tiling(info)`` decides from an image's header info whether it is
+    tiled, as ``/detect`` does, so both routes give the same boxes and share
+    cache entries. Images wait up to ``timeout`` for room in a full inference
+    queue. Closing the generator (the client went away) cancels whatever has
+    not started yet.
+    """
+    sources = enumerate(sources)
+    pending = {}       # future -> (stage, item)
+    backlog = deque()  # decoded items waiting for room in the inference queue
+    tiler = None       # helper threads for tiled images, started on the first one
+    exhausted = False
+    count = failed = 0
+    variant = tiled_variant(tile, overlap)
+
+    def decoding():
+        return sum(1 for s, _ in pending.values() if s == "decode")
+
+    def result(item, dets, cache_status):
+        return {
+            "index": item["index"], "filename": item["filename"], "ok": True,
+            "detections": dets,
+            "meta": {"width": item["width"], "height": item["height"],
+                     "format": item["format"], "cache": cache_status,
+                     "tiles": item.get("tiles", 0)},
+        }
+
+    try:
+        while True:
+            # Top up the decode stage; cache hits are answered without decoding
+            # Decoded images waiting in the backlog count too, so memory stays bounded
+            while not exhausted and decoding() + len(backlog) < max_inflight:
+                try:
+                    index, (name, read) = next(sources)
+                except StopIteration:
+                    exhausted = True
+                    break
+                count += 1
+                try:
+                    data = read()
+                    tiled = False
+                    if use_tiling is not None:
+                        # The header alone decides, before any pixels are decoded
+                        tiled = use_tiling(image_info(open_image(io.BytesIO(data))))
+                except Exception as e:
+                    failed += 1
+                    yield _failure(index, name, e)
+                    continue
+                with timed("hash"):
+                    digest = hashlib.sha256(data).hexdigest()
+                item = {"index": index, "filename": name, "digest": digest,
+                        "variant": variant if tiled else ""}
+                item["key"] = cache.key(item["digest"], item["variant"])
+                hit = cache.get(item["key"])
+                if hit is not None:
+                    item.update(width=hit["width"], height=hit["height"], format=None)
+                    yield result(item, hit["detections"], "hit")
+                    continue
+                try:
+                    if tiled:
+                        future = pool.submit(decode_tiles, data, imgsz, tile, overlap)
+                    else:
+                        future = pool.submit(decode_bytes, data, imgsz)
+                    pending[future] = ("decode", item)
+                except (BrokenProcessPool, BrokenThreadPool) as e:
+                    # The replacement pool broke straight away too
+                    failed += 1
+                    yield _failure(index, name, e)
+
+            # Move decoded images into the inference queue while it has room;
+            # when it is full (other requests count too) they wait up to timeout
+            while backlog:
+                item = backlog[0]
+                if item["variant"]:
+                    if sum(1 for s, i in pending.values() if s == "infer" and i["variant"]) >= TILED_WORKERS:
+                        break
+                    if tiler is None:
+                        tiler = ThreadPoolExecutor(max_workers=TILED_WORKERS, thread_name_prefix="batch-tiled")
+                    future = tiler.submit(_detect_tiled, item, batcher, imgsz, timeout, iou_threshold)
+                else:
+                    try:
+                        future = batcher.submit(item["array"])
+                    except QueueFull as e:
+                        if time.monotonic() - item.setdefault("blocked", time.monotonic()) > timeout:
+                            backlog.popleft()
+                            failed += 1
+                            yield _failure(item["index"], item["filename"], e)
+                            continue
+                        break
+                pending[future] = ("infer", backlog.popleft())
+
+            if not pending:
+                if exhausted and not backlog:
+                    break
+                time.sleep(0.05)  # only waiting for room in the queue
+                continue
+
+            done, _ = wait(pending, timeout=0.05 if backlog else timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                if backlog:
+                    continue
+                stuck = [item for _, item in pending.values()]
+                for future in pending:
+                    future.cancel()
+                pending.clear()
+                for item in stuck:
+                    failed += 1
+                    yield _failure(item["index"], item["filename"], TimeoutError())
+                continue
+
+            for future in done:
+                stage, item = pending.pop(future)
+                try:
+                    out = future.result()
+                except Exception as e:
+                    if isinstance(e, (BrokenProcessPool, BrokenThreadPool)) and stage == "decode":
+                        # Later images (and requests) get a fresh pool; the images
+                        # that were on the dead one fail with this error
+                        pool.replace(future.executor)
+                    failed += 1
+                    yield _failure(item["index"], item["filename"], e)
+                    continue
+
+                if stage == "decode":
+                    record("decode", out.pop("decode_s"))
+                    if item["variant"]:
+                        views = out.pop("views")
+                        content = views["content"]
+                        item["views"] = views
+                        item["tiles"] = len(views["crops"])
+                    else:
+                        x = out.pop("array")
+                        new_w, new_h, pad_x, pad_y = letterbox_geometry(out["width"], out["height"], imgsz)
+                        content = x[pad_y:pad_y + new_h, pad_x:pad_x + new_w]
+                        item["array"] = x
+                    item.update(out)
+                    item["fp"] = None
+                    if cache.enabled and cache.phash:
+                        with timed("phash"):
+                            item["fp"] = fingerprint(content)
+                        hit = cache.get_similar(item["fp"], item["width"], item["height"], item["variant"])
+                        if hit is not None:
+                            item.pop("views", None)
+                            item.pop("array", None)
+                            yield result(item, hit["detections"], "near_hit")
+                            continue
+                    backlog.append(item)
+                else:
+                    if item["variant"]:
+                        dets = out
+                    else:
+                        record("queue", future.queue_wait_s)
+                        record("inference", future.forward_s)
+                        dets = unletterbox(out, item["width"], item["height"], imgsz)
+                    cache.miss()
+                    cache.put(item["key"], dets, item["width"], item["height"], item["fp"], item["variant"])
+                    yield result(item, dets, "miss" if cache.enabled else "off")
+
+        yield {"done": True, "count": count, "ok": count - failed, "errors": failed}
+    finally:
+        # Normal end, error, or GeneratorExit when the client disconnects
+        for future in pending:
+            future.cancel()
+        if tiler is not None:
+            tiler.shutdown(wait=False, cancel_futures=True)
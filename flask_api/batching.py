@@ -0,0 +1,188 @@
+"""Dynamic micro-batching between the route handlers and the model.
+
+Request threads submit one preprocessed image each and get a Future back. A
+single worker thread drains the queue and runs one batched forward pass as
+soon as ``max_batch`` images are waiting or the oldest one has waited
+``max_wait_ms``, whichever comes first.
+"""
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class QueueFull(Exception):
+    """Raised when the scheduler already holds ``max_queue`` pending images."""
+
+
+class _Item:
+    __slots__ = ("x", "future", "enqueued")
+
+    def __init__(self, x):
+        self.x = x
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    return round(float(np.percentile(np.fromiter(values, dtype=np.float64), q)), 3)
+
+
+class MicroBatcher:
+    def __init__(self, predict_fn, max_batch: int = 8, max_wait_ms: float = 5.0,
+                 max_queue: int = 64, window: int = 1024):
+        self.predict_fn = predict_fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.max_queue = max(1, max_queue)
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._submit_lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+        # Stats; the recent windows feed the percentiles
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._waits_ms = deque(maxlen=window)
+        self._forward_ms = deque(maxlen=window)
+        self._submitted = 0
+        self._rejected = 0
+        self._failed_batches = 0
+
+    # --- Lifecycle ---
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: float | None = 5.0):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join(timeout)
+            self._thread = None
+
+    # --- Public API ---
+    def submit(self, x) -> Future:
+        """Queue one preprocessed image; the Future resolves to its detections."""
+        return self._enqueue([x], f"inference queue is full ({self.max_queue} pending)")[0]
+
+    def submit_many(self, xs) -> list[Future]:
+        """Queue several images back to back so they tend to share a batch.
+
+        Raises QueueFull up front, without queueing any of them, if they would
+        not all fit.
+        """
+        xs = list(xs)
+        return self._enqueue(xs, f"inference queue cannot take {len(xs)} more images")
+
+    def _enqueue(self, xs, message: str) -> list[Future]:
+        items = [_Item(x) for x in xs]
+        # Producers check and put under one lock; the worker only takes items
+        # out, so the room seen by the check is still there for every put
+        with self._submit_lock:
+            if self._queue.qsize() + len(items) > self.max_queue:
+                with self._stats_lock:
+                    self._rejected += len(items)
+                raise QueueFull(message)
+            for item in items:
+                self._queue.put_nowait(item)
+        with self._stats_lock:
+            self._submitted += len(items)
+        return [item.future for item in items]
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            batches = sum(self._batch_sizes.values())
+            items = sum(size * n for size, n in self._batch_sizes.items())
+            waits = list(self._waits_ms)
+            forwards = list(self._forward_ms)
+            return {
+                "max_batch": self.max_batch,
+                "max_wait_ms": self.max_wait * 1000,
+                "max_queue": self.max_queue,
+                "queue_depth": self._queue.qsize(),
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "batches": batches,
+                "failed_batches": self._failed_batches,
+                "mean_batch_size": round(items / batches, 3) if batches else None,
+                "batch_sizes": {str(k): v for k, v in sorted(self._batch_sizes.items())},
+                "queue_wait_ms": {
+                    "p50": _percentile(waits, 50),
+                    "p95": _percentile(waits, 95),
+                    "p99": _percentile(waits, 99),
+                },
+                "forward_ms": {
+                    "p50": _percentile(forwards, 50),
+                    "p95": _percentile(forwards, 95),
+                },
+            }
+
+    # --- Worker ---
+    def _collect(self) -> list[_Item]:
+        try:
+            first = self._queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = first.enqueued + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # Deadline passed: still take whatever is already waiting
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+        # Drain so no caller is left waiting on shutdown
+        while True:
+            batch = self._collect()
+            if not batch:
+                break
+            self._flush(batch)
+
+    def _flush(self, batch: list[_Item]):
+        dispatched = time.perf_counter()
+        live = [item for item in batch if item.future.set_running_or_notify_cancel()]
+        if not live:
+            return
+        try:
+            results = self.predict_fn(np.stack([item.x for item in live]))
+        except Exception as e:
+            with self._stats_lock:
+                self._failed_batches += 1
+            for item in live:
+                item.future.set_exception(e)
+            return
+        finished = time.perf_counter()
+
+        for item, result in zip(live, results):
+            # Lets callers split their wait into queueing and model time
+            item.future.queue_wait_s = dispatched - item.enqueued
+            item.future.forward_s = finished - dispatched
+            item.future.set_result(result)
+
+        with self._stats_lock:
+            self._batch_sizes[len(live)] += 1
+            self._forward_ms.append((finished - dispatched) * 1000)
+            self._waits_ms.extend((dispatched - item.enqueued) * 1000 for item in live)
@@ -0,0 +1,66 @@
+"""Helpers shared by the benchmark scripts."""
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def reset_peak(pid: int | str = "self"):
+    """Reset a process's peak RSS (Linux VmHWM); a no-op elsewhere.
+
+    ru_maxrss survives exec, so without this a child would start from its
+    parent's peak.
+    """
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_kb(pid: int | str = "self") -> int | None:
+    """Peak RSS in KiB since start or the last reset_peak(); None if unknown."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if pid != "self" or resource is None:
+        return None
+    # Linux reports kilobytes, macOS bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def peak_rss_mb(pid: int | str = "self") -> float | None:
+    kb = peak_rss_kb(pid)
+    return round(kb / 1024, 1) if kb is not None else None
+
+
+def summarize(latencies_s) -> dict:
+    """p50/p95/p99/mean of a list of durations in seconds, in milliseconds."""
+    ms = np.asarray(latencies_s, dtype=np.float64) * 1000
+    if ms.size == 0:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None}
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3),
+            "p99_ms": round(float(p99), 3), "mean_ms": round(float(ms.mean()), 3)}
+
+
+def repeat(fn, n: int, warmup: int = 2) -> list[float]:
+    """Call ``fn`` n times after a warm-up and return each call's duration."""
+    for _ in range(warmup):
+        fn()
+    out = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        out.append(time.perf_counter() - start)
+    return out
@@ -0,0 +1,43 @@
+"""Deterministic synthetic leaf images for the benchmarks."""
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+RESOLUTIONS = [(640, 480), (1280, 960), (2016, 1512), (4032, 3024)]
+FORMATS = [("JPEG", "jpg"), ("PNG", "png"), ("WEBP", "webp")]
+
+
+def leaf(width: int, height: int, seed: int = 0) -> Image.Image:
+    """A calamansi-ish leaf: green ellipse on a blurred background, with
+    a few dark lesions and sensor-like noise so encoders do real work."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    bg = np.stack([60 + 40 * xx / width, 90 + 60 * yy / height, 50 + 20 * xx / width], axis=-1)
+    img = Image.fromarray(bg.astype(np.uint8))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((width * 0.15, height * 0.2, width * 0.85, height * 0.8), fill=(70, 140, 50))
+    for _ in range(12):
+        cx, cy = rng.uniform(0.3, 0.7) * width, rng.uniform(0.35, 0.65) * height
+        r = rng.uniform(0.004, 0.02) * width
+        draw.ellipse((cx - r, cy - r, cx + r, cy + r), fill=(90, 60, 30))
+    arr = np.asarray(img, dtype=np.int16) + rng.integers(-8, 9, (height, width, 3), dtype=np.int16)
+    return Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8))
+
+
+def encode(img: Image.Image, fmt: str, quality: int = 90) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, fmt, quality=quality)
+    return buf.getvalue()
+
+
+def synthetic_set(resolutions=RESOLUTIONS, formats=FORMATS, seed: int = 0) -> list[dict]:
+    """Every resolution in every format: dicts of name, ext, format, size and data."""
+    out = []
+    for i, (w, h) in enumerate(resolutions):
+        img = leaf(w, h, seed + i)
+        for fmt, ext in formats:
+            out.append({"name": f"{ext}_{w}x{h}", "ext": ext, "format": fmt,
+                        "size": (w, h), "data": encode(img, fmt)})
+    return out
+
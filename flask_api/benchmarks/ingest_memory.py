@@ -0,0 +1,116 @@
+"""Peak memory of the old vs. streaming image ingest path.
+
+Each strategy runs in a fresh spawned process so its peak RSS is measured in
+isolation: the child resets its peak RSS after its imports, ingests the image
+once and reports the growth. Pillow allocates pixel buffers outside the Python
+heap, so tracemalloc would not see them.
+
+    python benchmarks/ingest_memory.py [image ...]
+
+Without arguments a synthetic 12 MP JPEG and PNG are generated.
+"""
+import io
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from benchmarks.common import peak_rss_kb, reset_peak  # noqa: E402
+
+IMGSZ = 640
+
+
+def legacy(path: str):
+    """The original predict(): read all bytes, full-resolution RGB decode."""
+    from PIL import Image
+    import numpy as np
+
+    with open(path, "rb") as f:
+        image_bytes = f.read()
+    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    x = np.asarray(img.resize((IMGSZ, IMGSZ), Image.BILINEAR))
+    return x.shape
+
+
+def streaming(path: str):
+    """The ingest module: chunked hash, header check, draft decode to model size."""
+    import numpy as np
+    from ingest import decode_to, open_image, sha256_stream
+
+    with open(path, "rb") as f:
+        sha256_stream(f)
+        img = open_image(f)
+        x = np.asarray(decode_to(img, (IMGSZ, IMGSZ)))
+    return x.shape
+
+
+STRATEGIES = {"legacy": legacy, "streaming": streaming}
+
+
+def _child(name: str, path: str, out):
+    import numpy  # noqa: F401  (import cost must not count towards the ingest)
+    import PIL.Image  # noqa: F401
+    import ingest  # noqa: F401
+
+    reset_peak()
+    before = peak_rss_kb()
+    start = time.perf_counter()
+    STRATEGIES[name](path)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    out.put({"peak_kb": peak_rss_kb() - before, "ms": elapsed_ms})
+
+
+def measure(name: str, path: str) -> dict:
+    ctx = mp.get_context("spawn")
+    out = ctx.Queue()
+    p = ctx.Process(target=_child, args=(name, path, out))
+    p.start()
+    result = out.get()
+    p.join()
+    return result
+
+
+def synthetic_images(tmpdir: str) -> list[str]:
+    """12 MP leaf-green gradient with noise, as JPEG and PNG."""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    h, w = 3024, 4032
+    base = np.zeros((h, w, 3), dtype=np.uint8)
+    base[..., 1] = np.linspace(90, 200, w, dtype=np.uint8)[None, :]
+    base[..., 0] = np.linspace(30, 90, h, dtype=np.uint8)[:, None]
+    base = np.clip(base + rng.integers(0, 24, base.shape, dtype=np.uint8), 0, 255).astype(np.uint8)
+    img = Image.fromarray(base)
+    paths = []
+    for fmt, ext in (("JPEG", "jpg"), ("PNG", "png")):
+        path = os.path.join(tmpdir, f"synthetic_12mp.{ext}")
+        img.save(path, fmt, quality=90)
+        paths.append(path)
+    return paths
+
+
+def main(argv: list[str]) -> int:
+    if peak_rss_kb() is None:
+        print("peak RSS is not available on this platform", file=sys.stderr)
+        return 1
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = argv or synthetic_images(tmpdir)
+        print(f"{'image':<28}{'size':>9}  {'legacy MB':>10}{'stream MB':>10}{'saved MB':>10}"
+              f"{'legacy ms':>11}{'stream ms':>11}")
+        for path in paths:
+            old = measure("legacy", path)
+            new = measure("streaming", path)
+            saved = (old["peak_kb"] - new["peak_kb"]) / 1024
+            print(f"{os.path.basename(path):<28}{os.path.getsize(path) / 1e6:>8.1f}M  "
+                  f"{old['peak_kb'] / 1024:>10.1f}{new['peak_kb'] / 1024:>10.1f}{saved:>10.1f}"
+                  f"{old['ms']:>11.1f}{new['ms']:>11.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,144 @@
+"""Load tests for /predict and /detect.
+
+Two drivers share one code path: the Flask test client in this process, and
+HTTP against a production WSGI server (waitress) launched as a subprocess.
+The prediction cache is disabled in both so every request does real work.
+"""
+import io
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import peak_rss_mb, reset_peak, summarize
+
+FLASK_API = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Applied before the app is imported/launched so the numbers reflect inference
+BENCH_ENV = {
+    "CACHE_MAX_ENTRIES": "0",
+    "DECODE_WORKERS": "0",
+    "MODEL_BACKEND": "numpy",
+}
+
+
+def _drive(post, uploads: list[tuple[str, bytes]], concurrency: int, requests: int) -> dict:
+    """Send ``requests`` uploads with ``concurrency`` threads via ``post(name, data)``."""
+    latencies, errors = [], 0
+
+    def one(i):
+        name, data = uploads[i % len(uploads)]
+        start = time.perf_counter()
+        status = post(name, data)
+        return time.perf_counter() - start, status
+
+    wall = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for elapsed, status in pool.map(one, range(requests)):
+            latencies.append(elapsed)
+            errors += status != 200
+    wall = time.perf_counter() - wall
+    return {**summarize(latencies), "rps": round(requests / wall, 2), "errors": errors}
+
+
+# --- Flask test client ---
+def run_test_client(uploads, endpoints, concurrencies, requests: int) -> dict:
+    os.environ.update(BENCH_ENV)
+    os.environ.setdefault("RENDER_DIR", tempfile.mkdtemp(prefix="calasense-bench-"))
+    from app import create_app  # imported late so BENCH_ENV applies
+    app = create_app()
+
+    results = {}
+    for endpoint in endpoints:
+        for c in concurrencies:
+            def post(name, data):
+                client = app.test_client()
+                return client.post(endpoint, data={"image": (io.BytesIO(data), name)}).status_code
+
+            _drive(post, uploads, c, min(requests, 2 * c))  # warm-up
+            reset_peak()
+            stats = _drive(post, uploads, c, requests)
+            stats["peak_rss_mb"] = peak_rss_mb()
+            results[f"load.testclient.{endpoint.strip('/')}.c{c}"] = stats
+    return results
+
+
+# --- Production WSGI server over HTTP ---
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _multipart(name: str, data: bytes) -> tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"image\"; filename=\"{name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode()
+    return head + data + f"\r\n--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+
+def start_server(threads: int = 8, timeout_s: float = 60.0):
+    """Launch waitress serving app:create_app; returns (process, base_url)."""
+    try:
+        import waitress  # noqa: F401
+    except ImportError:
+        raise RuntimeError("waitress is not installed; pip install -r requirements.txt")
+    port = _free_port()
+    env = {**os.environ, **BENCH_ENV,
+           "RENDER_DIR": tempfile.mkdtemp(prefix="calasense-bench-")}
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "waitress", "--listen", f"127.0.0.1:{port}",
+         f"--threads={threads}", "--call", "app:create_app"],
+        cwd=FLASK_API, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited: {proc.stderr.read().decode()[-2000:]}")
+        try:
+            with urllib.request.urlopen(f"{base}/health", timeout=1):
+                return proc, base
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("server did not become healthy in time")
+
+
+def run_server(uploads, endpoints, concurrencies, requests: int, threads: int = 8) -> dict:
+    proc, base = start_server(threads)
+    results = {}
+    try:
+        for endpoint in endpoints:
+            for c in concurrencies:
+                def post(name, data):
+                    body, ctype = _multipart(name, data)
+                    req = urllib.request.Request(f"{base}{endpoint}", data=body, method="POST",
+                                                 headers={"Content-Type": ctype})
+                    try:
+                        with urllib.request.urlopen(req, timeout=60) as resp:
+                            resp.read()
+                            return resp.status
+                    except urllib.error.HTTPError as e:
+                        return e.code
+                    except OSError:
+                        return 0
+
+                _drive(post, uploads, c, min(requests, 2 * c))  # warm-up
+                reset_peak(proc.pid)
+                stats = _drive(post, uploads, c, requests)
+                stats["peak_rss_mb"] = peak_rss_mb(proc.pid)
+                results[f"load.server.{endpoint.strip('/')}.c{c}"] = stats
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return results
@@ -0,0 +1,49 @@
+"""Micro-benchmarks of the request path stages, each measured on its own."""
+import json
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.common import repeat, summarize
+from cache import fingerprint
+from inference import InferenceEngine
+from ingest import decode_bytes
+from tiling import nms
+
+
+def run(images: list[dict], n: int = 20) -> dict:
+    engine = InferenceEngine(backend="numpy")
+    engine.warmup()
+    size = engine.imgsz
+    results = {}
+
+    # Decode: header check plus draft decode to the model input size
+    for im in images:
+        results[f"micro.decode.{im['name']}"] = summarize(
+            repeat(lambda: decode_bytes(im["data"], size), n))
+
+    # Preprocess: letterbox a typical draft-decoded frame and fingerprint it for the cache
+    frame = Image.fromarray(np.zeros((756, 1008, 3), dtype=np.uint8))
+    results["micro.preprocess.1008x756"] = summarize(
+        repeat(lambda: (engine.preprocess(frame), fingerprint(frame)), n))
+
+    # Inference: one forward pass at batch 1 and 8
+    rng = np.random.default_rng(0)
+    for batch in (1, 8):
+        x = rng.integers(0, 256, (batch, size, size, 3), dtype=np.uint8)
+        results[f"micro.inference.b{batch}"] = summarize(repeat(lambda: engine.predict_batch(x), n))
+
+    # Serialization of a /detect body with few and many boxes
+    for count in (25, 200):
+        dets = [{"name": "canker", "class_id": 2, "confidence": 0.5 + i / 1000,
+                 "box": [i * 1.5, i * 2.5, i * 1.5 + 30.0, i * 2.5 + 30.0]} for i in range(count)]
+        body = {"ok": True, "detections": dets, "annotated_url": "/annotated/x.jpg",
+                "meta": {"width": 4032, "height": 3024, "timings": {"decode": 12.3}}}
+        results[f"micro.serialize.d{count}"] = summarize(repeat(lambda: json.dumps(body), n * 5))
+
+    # Tile merge NMS over a dense set of boxes
+    xy = rng.uniform(0, 4000, (500, 2))
+    boxes = np.hstack([xy, xy + rng.uniform(20, 200, (500, 2))])
+    scores, classes = rng.uniform(size=500), rng.integers(0, 5, 500)
+    results["micro.nms.500"] = summarize(repeat(lambda: nms(boxes, scores, classes), n))
+    return results
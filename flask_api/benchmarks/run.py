@@ -0,0 +1,169 @@
+"""Offline benchmark suite for the Flask API.
+
+    cd flask_api
+    python -m benchmarks.run                      # full run, compare to baseline
+    python -m benchmarks.run --quick              # small images, fewer requests
+    python -m benchmarks.run --update-baseline    # record a new baseline
+
+Runs the micro-benchmarks and the load tests (Flask test client, then a
+waitress server over HTTP), writes the results to --output and compares
+p50/p95 latency, requests per second and peak RSS against the baseline
+file. p99 is reported but not gated, since it is too noisy at these sample
+sizes. The run exits with status 1 if any metric is worse than the
+baseline by more than --tolerance, if any request failed, or if a
+benchmark the baseline has did not produce a result (including a waitress
+server that would not start). Only benchmarks deselected on the command
+line (--skip-micro, --drivers, --endpoints, --concurrency) may be missing.
+A --quick run needs a baseline recorded with --quick. Baselines are
+machine-specific, so none is checked in: record benchmarks/baseline.json
+with --update-baseline on the host that runs the comparison.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from benchmarks import load, micro  # noqa: E402
+from benchmarks.images import RESOLUTIONS, synthetic_set  # noqa: E402
+
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "peak_rss_mb")
+HIGHER_IS_BETTER = ("rps",)
+
+
+def compare(current: dict, baseline: dict, tolerance: float,
+            expected=lambda key: True) -> list[str]:
+    """Regressions of ``current`` against ``baseline`` as printable lines.
+
+    A baseline key missing from ``current`` is a regression unless
+    ``expected(key)`` is false, i.e. the run was told not to produce it.
+    """
+    problems = []
+    for key, base in sorted(baseline.items()):
+        cur = current.get(key)
+        if cur is None:
+            if expected(key):
+                problems.append(f"{key}: missing from results")
+            continue
+        if cur.get("errors"):
+            problems.append(f"{key}: {cur['errors']} failed requests")
+        for metric in LOWER_IS_BETTER:
+            if base.get(metric) and cur.get(metric) is not None:
+                if cur[metric] > base[metric] * (1 + tolerance):
+                    problems.append(f"{key}.{metric}: {cur[metric]} > baseline {base[metric]}")
+        for metric in HIGHER_IS_BETTER:
+            if base.get(metric) and cur.get(metric) is not None:
+                if cur[metric] < base[metric] * (1 - tolerance):
+                    problems.append(f"{key}.{metric}: {cur[metric]} < baseline {base[metric]}")
+    return problems
+
+
+def print_table(results: dict):
+    cols = ("p50_ms", "p95_ms", "p99_ms", "rps", "peak_rss_mb", "errors")
+    print(f"{'benchmark':<40}" + "".join(f"{c:>12}" for c in cols))
+    for key, stats in results.items():
+        cells = "".join(f"{'' if stats.get(c) is None else stats[c]:>12}" for c in cols)
+        print(f"{key:<40}{cells}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--quick", action="store_true", help="small images and few requests")
+    parser.add_argument("--concurrency", default="1,4,8", help="comma-separated levels")
+    parser.add_argument("--requests", type=int, default=64, help="requests per load level")
+    parser.add_argument("--endpoints", default="/predict,/detect")
+    parser.add_argument("--drivers", default="testclient,server",
+                        help="testclient and/or server (waitress)")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--baseline", default=os.path.join(HERE, "baseline.json"))
+    parser.add_argument("--output", default=os.path.join(HERE, "results.json"))
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed fractional regression before failing")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    concurrencies = [int(c) for c in args.concurrency.split(",")]
+    endpoints = args.endpoints.split(",")
+    drivers = args.drivers.split(",")
+    resolutions = RESOLUTIONS
+    requests = args.requests
+    if args.quick:
+        resolutions, concurrencies, requests = RESOLUTIONS[:2], concurrencies[:2], min(requests, 24)
+
+    images = synthetic_set(resolutions)
+    # Load tests upload JPEGs like the phone app does, across every resolution
+    uploads = [(f"{im['name']}.{im['ext']}", im["data"]) for im in images if im["format"] == "JPEG"]
+
+    def expected(key: str) -> bool:
+        kind, rest = key.split(".", 1)
+        if kind == "micro":
+            return not args.skip_micro
+        driver, endpoint, level = rest.rsplit(".", 2)
+        return (driver in drivers and endpoint in {e.strip("/") for e in endpoints}
+                and int(level[1:]) in concurrencies)
+
+    results = {}
+    failures = []
+    started = time.time()
+    if not args.skip_micro:
+        results.update(micro.run(images, n=10 if args.quick else 20))
+    if "testclient" in drivers:
+        results.update(load.run_test_client(uploads, endpoints, concurrencies, requests))
+    if "server" in drivers:
+        try:
+            results.update(load.run_server(uploads, endpoints, concurrencies, requests))
+        except RuntimeError as e:
+            print(f"server load test did not run: {e}", file=sys.stderr)
+            failures.append(f"server load test did not run: {e}")
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "quick": args.quick,
+            "requests": requests,
+            "duration_s": round(time.time() - started, 1),
+        },
+        "results": results,
+    }
+    print_table(results)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nwrote {args.output}")
+
+    if args.update_baseline:
+        if failures:
+            print("not updating the baseline from an incomplete run", file=sys.stderr)
+            return 1
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"updated baseline {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline to compare against; run with --update-baseline", file=sys.stderr)
+        return 1 if failures else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["meta"].get("quick", False) != args.quick:
+        mode = "--quick" if baseline["meta"].get("quick") else "full"
+        print(f"{args.baseline} was recorded by a {mode} run; compare like with like "
+              f"(pass --baseline, or record one with --update-baseline)", file=sys.stderr)
+        return 1
+    problems = failures + compare(results, baseline["results"], args.tolerance, expected)
+    if problems:
+        print(f"\n{len(problems)} regression(s) beyond {args.tolerance:.0%}:")
+        for line in problems:
+            print(f"  {line}")
+        return 1
+    print(f"\nno regressions beyond {args.tolerance:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
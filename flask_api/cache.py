@@ -0,0 +1,291 @@
+"""Content-addressed cache of detection results.
+
+Entries are keyed by the SHA-256 of the uploaded bytes combined with the model
+version, so a model swap never serves stale boxes. The in-memory tier is an
+LRU bounded by entry count and approximate size, with a TTL. An optional disk
+tier (one JSON file per key) survives restarts; it is swept of expired files
+at startup and trimmed oldest-first whenever it outgrows its byte budget. An
+optional near-duplicate index lets re-encoded or resized copies of an image
+hit the cache too: a 256-bit difference hash of the unpadded picture finds
+candidates, and a 32x32 grayscale thumbnail has to match before one is served,
+since hashes of different leaves shot with the same framing can be close.
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from inference import scale_detections
+
+# Popcount of every byte value, used for vectorised Hamming distances
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def dhash(img, size: int = 16) -> str:
+    """``size * size``-bit difference hash of an image (PIL image or RGB uint8 array), as hex."""
+    if isinstance(img, np.ndarray):
+        img = Image.fromarray(img)
+    small = np.asarray(img.convert("L").resize((size + 1, size), Image.BOX), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return np.packbits(bits).tobytes().hex()
+
+
+def thumbnail(img, size: int = 32) -> str:
+    """``size x size`` grayscale thumbnail of an image, base64-encoded."""
+    if isinstance(img, np.ndarray):
+        img = Image.fromarray(img)
+    small = np.asarray(img.convert("L").resize((size, size), Image.BOX), dtype=np.uint8)
+    return base64.b64encode(small.tobytes()).decode("ascii")
+
+
+def fingerprint(img) -> dict:
+    """Near-duplicate fingerprint of the picture itself, without letterbox padding."""
+    return {"phash": dhash(img), "thumb": thumbnail(img)}
+
+
+def _words(phash: str) -> np.ndarray:
+    return np.frombuffer(bytes.fromhex(phash), dtype=">u8").astype(np.uint64)
+
+
+def _pixels(thumb: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(thumb), dtype=np.uint8).astype(np.int16)
+
+
+def hamming(hashes: np.ndarray, h) -> np.ndarray:
+    """Hamming distance from ``h`` to every hash in ``hashes`` (uint64, one row of words per hash)."""
+    x = np.bitwise_xor(hashes, np.asarray(h, dtype=np.uint64))
+    return _POPCOUNT[x.view(np.uint8).reshape(len(x), -1)].sum(axis=1)
+
+
+class PredictionCache:
+    def __init__(self, model_version: str, max_entries: int = 1024, max_bytes: int = 64 << 20,
+                 ttl_s: float = 86400, disk_dir: str | None = None,
+                 disk_max_bytes: int = 256 << 20, phash: bool = False, phash_distance: int = 64,
+                 thumb_tolerance: int = 8):
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.disk_dir = os.path.join(disk_dir, model_version) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self.phash = phash
+        self.phash_distance = phash_distance
+        self.thumb_tolerance = thumb_tolerance
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, nbytes, value)
+        self._bytes = 0
+        self._phash_keys = []
+        self._phash_values = np.empty((0, 4), dtype=np.uint64)  # 256-bit hashes as 4 words
+        self.counters = {"hits": 0, "near_hits": 0, "disk_hits": 0, "misses": 0,
+                         "evictions": 0, "expirations": 0, "disk_evictions": 0}
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.sweep_disk()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def key(self, digest: str, variant: str = "") -> str:
+        """Cache key for the SHA-256 hex digest of an upload.
+
+        ``variant`` separates results produced by different inference modes
+        (e.g. tiled) for the same bytes.
+        """
+        return hashlib.sha256(f"{self.model_version}:{variant}:{digest}".encode()).hexdigest()
+
+    # --- Lookups ---
+    def get(self, key: str) -> dict | None:
+        """Exact lookup by content key, falling back to the disk tier."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, _, value = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return value
+                self._drop(key)
+                self.counters["expirations"] += 1
+
+        value = self._disk_get(key, now)
+        if value is not None:
+            with self._lock:
+                self.counters["hits"] += 1
+                self.counters["disk_hits"] += 1
+                self._insert(key, value, now)
+        return value
+
+    def get_similar(self, fp: dict, width: int, height: int, variant: str = "") -> dict | None:
+        """Near-duplicate lookup by ``fingerprint``; boxes are rescaled to the new image size.
+
+        Candidates within ``phash_distance`` bits are confirmed by their
+        thumbnails: no pixel may differ by more than ``thumb_tolerance``.
+        """
+        if not (self.enabled and self.phash):
+            return None
+        now = time.time()
+        with self._lock:
+            if not self._phash_keys:
+                return None
+            dist = hamming(self._phash_values, _words(fp["phash"]))
+            thumb = None
+            for i in np.argsort(dist, kind="stable"):
+                if dist[i] > self.phash_distance:
+                    break
+                key = self._phash_keys[i]
+                expires, _, value = self._entries[key]
+                if expires <= now or value.get("variant", "") != variant:
+                    continue
+                # Crops or different aspect ratios are not the same picture
+                if abs(value["width"] / value["height"] - width / height) > 0.02:
+                    continue
+                if thumb is None:
+                    thumb = _pixels(fp["thumb"])
+                if np.abs(_pixels(value["thumb"]) - thumb).max() > self.thumb_tolerance:
+                    continue
+                self._entries.move_to_end(key)
+                self.counters["near_hits"] += 1
+                return {**value,
+                        "detections": scale_detections(value["detections"], width / value["width"],
+                                                       height / value["height"]),
+                        "width": width, "height": height}
+        return None
+
+    def miss(self):
+        with self._lock:
+            self.counters["misses"] += 1
+
+    # --- Inserts ---
+    def put(self, key: str, detections: list[dict], width: int, height: int,
+            fp: dict | None = None, variant: str = ""):
+        """Store a result; ``fp`` (see ``fingerprint``) adds it to the near-duplicate index."""
+        if not self.enabled:
+            return
+        value = {"detections": detections, "width": width, "height": height,
+                 "phash": fp["phash"] if fp else None, "thumb": fp["thumb"] if fp else None,
+                 "variant": variant}
+        now = time.time()
+        with self._lock:
+            self._insert(key, value, now)
+        self._disk_put(key, value)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "entries": len(self._entries), "bytes": self._bytes,
+                    "max_entries": self.max_entries, "max_bytes": self.max_bytes,
+                    "disk": self.disk_dir is not None, "disk_bytes": self._disk_bytes,
+                    "disk_max_bytes": self.disk_max_bytes, "phash": self.phash}
+
+    def sweep_disk(self, now: float | None = None) -> int:
+        """Trim the disk tier; returns how many files were removed.
+
+        Expired entries and leftover temp files go first, then the oldest
+        entries until the tier is back under 90% of ``disk_max_bytes``, so a
+        full tier isn't swept again on the very next write. Other processes
+        may share the directory, so the size is re-read from disk each time.
+        """
+        if not self.disk_dir:
+            return 0
+        now = now or time.time()
+        with self._disk_lock:
+            files = []
+            for sub in os.scandir(self.disk_dir):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, entry.path))
+            files.sort()
+            total = sum(size for _, size, _ in files)
+            removed = 0
+            for mtime, size, path in files:
+                # Temp files younger than a minute may be another process's write in progress
+                stale = (path.endswith(".tmp") and mtime + 60 <= now) or mtime + self.ttl_s <= now
+                if not stale and total <= self.disk_max_bytes * 0.9:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            self._disk_bytes = total
+        with self._lock:
+            self.counters["disk_evictions"] += removed
+        return removed
+
+    # --- Internals (callers hold self._lock) ---
+    def _insert(self, key: str, value: dict, now: float):
+        if key in self._entries:
+            self._drop(key)
+        nbytes = len(json.dumps(value))
+        self._entries[key] = (now + self.ttl_s, nbytes, value)
+        self._bytes += nbytes
+        # Entries written before thumbnails existed stay exact-match only
+        if self.phash and value.get("thumb"):
+            self._phash_keys.append(key)
+            self._phash_values = np.vstack([self._phash_values, _words(value["phash"])])
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.counters["evictions"] += 1
+
+    def _drop(self, key: str):
+        _, nbytes, value = self._entries.pop(key)
+        self._bytes -= nbytes
+        if value.get("thumb") and key in self._phash_keys:
+            i = self._phash_keys.index(key)
+            del self._phash_keys[i]
+            self._phash_values = np.delete(self._phash_values, i, axis=0)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _disk_get(self, key: str, now: float) -> dict | None:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl_s <= now:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _disk_put(self, key: str, value: dict):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)  # atomic, so readers never see half a file
+        except OSError:
+            return
+        with self._disk_lock:
+            self._disk_bytes += size
+            full = self._disk_bytes > self.disk_max_bytes
+        if full:
+            self.sweep_disk()
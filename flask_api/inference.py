@@ -0,0 +1,293 @@
+"""CPU-only inference engine for the CalaSense API.
+
+The engine wraps a pluggable backend, loads its weights once per process and
+runs a warm-up pass before the first request is served. Backends take a batch
+of RGB uint8 arrays already letterboxed to ``imgsz x imgsz`` (resized with the
+aspect ratio kept and padded, as YOLO models are trained) and return one list
+of detections per image, with boxes in that input pixel space.
+"""
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+# Class names used by the mobile app (lib/components/disease_info.dart)
+CLASS_NAMES = ["healthy", "leaf miner", "canker", "greening", "black spot"]
+
+# Grey used by ultralytics for letterbox padding
+PAD_VALUE = 114
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()[:12]
+
+
+# --- Backends ---
+class NumpyBackend:
+    """Deterministic NumPy reference detector.
+
+    Splits the input into a ``stride``-sized grid, scores each cell from simple
+    colour statistics with a linear head and emits one box per cell whose
+    score passes ``conf``. It is not a trained model; it exists so the API can
+    be exercised and benchmarked offline with reproducible outputs. Weights are
+    read from an ``.npz`` file (``weights``, ``bias``, optional ``names``) when
+    one is given, otherwise generated from a fixed seed.
+    """
+
+    name = "numpy"
+    stride = 32
+    n_features = 9
+
+    def __init__(self, model_path: str | None = None, conf: float = 0.25,
+                 max_det: int = 100, seed: int = 0):
+        self.conf = conf
+        self.max_det = max_det
+        if model_path:
+            data = np.load(model_path)
+            self.weights = data["weights"].astype(np.float32)
+            self.bias = data["bias"].astype(np.float32)
+            self.names = [str(n) for n in data["names"]] if "names" in data else CLASS_NAMES
+            self.version = f"numpy-{_file_digest(model_path)}"
+        else:
+            rng = np.random.default_rng(seed)
+            self.names = CLASS_NAMES
+            # One objectness column followed by one column per class
+            self.weights = rng.normal(0, 1.0, (self.n_features, len(self.names) + 1)).astype(np.float32)
+            self.bias = rng.normal(0, 0.5, len(self.names) + 1).astype(np.float32)
+            # Only cells that stand out from the rest of the leaf should fire
+            self.bias[0] = -4.0
+            self.version = f"numpy-ref-seed{seed}"
+
+    def _features(self, batch: np.ndarray) -> np.ndarray:
+        n, h, w, _ = batch.shape
+        s = self.stride
+        gh, gw = h // s, w // s
+        x = batch[:, :gh * s, :gw * s].astype(np.float32) / 255.0
+        cells = x.reshape(n, gh, s, gw, s, 3)
+        mean = cells.mean(axis=(2, 4))
+        std = cells.std(axis=(2, 4))
+        r, g, b = mean[..., 0], mean[..., 1], mean[..., 2]
+        exg = 2 * g - r - b  # excess green: leaf vs lesion tissue
+        brightness = mean.mean(axis=-1)
+        yellow = (r + g) / 2 - b
+        feats = np.concatenate(
+            [mean, std, exg[..., None], brightness[..., None], yellow[..., None]], axis=-1
+        )
+        # Standardise per image so scores reflect contrast with the rest of the frame
+        mu = feats.mean(axis=(1, 2), keepdims=True)
+        sigma = feats.std(axis=(1, 2), keepdims=True) + 1e-6
+        return (feats - mu) / sigma
+
+    def predict(self, batch: np.ndarray) -> list[list[dict]]:
+        feats = self._features(batch)
+        logits = feats @ self.weights + self.bias
+        obj = _sigmoid(logits[..., 0])
+        cls = logits[..., 1:]
+        cls = np.exp(cls - cls.max(axis=-1, keepdims=True))
+        cls /= cls.sum(axis=-1, keepdims=True)
+        cls_id = cls.argmax(axis=-1)
+        score = obj * cls.max(axis=-1)
+
+        s = self.stride
+        out = []
+        for img_score, img_cls in zip(score, cls_id):
+            ys, xs = np.nonzero(img_score >= self.conf)
+            order = np.argsort(-img_score[ys, xs], kind="stable")[: self.max_det]
+            dets = []
+            for y, x in zip(ys[order], xs[order]):
+                c = int(img_cls[y, x])
+                dets.append({
+                    "name": self.names[c],
+                    "class_id": c,
+                    "confidence": float(img_score[y, x]),
+                    "box": [float(x * s), float(y * s), float((x + 1) * s), float((y + 1) * s)],
+                })
+            out.append(dets)
+        return out
+
+
+class UltralyticsBackend:
+    """YOLO weights loaded through ``ultralytics`` and pinned to the CPU."""
+
+    name = "ultralytics"
+
+    def __init__(self, model_path: str | None = None, conf: float = 0.25,
+                 max_det: int = 100, imgsz: int = 640):
+        if not model_path:
+            raise ValueError("MODEL_PATH is required for the ultralytics backend")
+        from ultralytics import YOLO  # optional dependency
+
+        self.model = YOLO(model_path)
+        self.names = [self.model.names[i] for i in sorted(self.model.names)]
+        self.conf = conf
+        self.max_det = max_det
+        self.imgsz = imgsz
+        self.version = f"ultralytics-{_file_digest(model_path)}"
+
+    def predict(self, batch: np.ndarray) -> list[list[dict]]:
+        # ultralytics expects BGR arrays like cv2.imread returns
+        frames = [np.ascontiguousarray(img[..., ::-1]) for img in batch]
+        results = self.model.predict(frames, imgsz=self.imgsz, conf=self.conf,
+                                     max_det=self.max_det, device="cpu", verbose=False)
+        out = []
+        for r in results:
+            boxes = r.boxes
+            xyxy = boxes.xyxy.numpy().tolist()
+            confs = boxes.conf.numpy().tolist()
+            classes = boxes.cls.numpy().astype(int).tolist()
+            out.append([
+                {"name": self.names[c], "class_id": c, "confidence": float(p), "box": b}
+                for b, p, c in zip(xyxy, confs, classes)
+            ])
+        return out
+
+
+BACKENDS = {
+    "numpy": NumpyBackend,
+    "ultralytics": UltralyticsBackend,
+}
+
+
+# --- Engine ---
+class InferenceEngine:
+    def __init__(self, backend: str = "auto", model_path: str | None = None,
+                 imgsz: int = 640, conf: float = 0.25):
+        if backend == "auto":
+            backend = "ultralytics" if model_path and model_path.endswith(".pt") else "numpy"
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown model backend '{backend}'")
+
+        self.imgsz = imgsz
+        kwargs = {"model_path": model_path, "conf": conf}
+        if backend == "ultralytics":
+            kwargs["imgsz"] = imgsz
+        start = time.perf_counter()
+        self.backend = BACKENDS[backend](**kwargs)
+        self.load_ms = (time.perf_counter() - start) * 1000
+        self.warmup_ms = None
+        self._lock = threading.Lock()
+
+    @property
+    def backend_name(self) -> str:
+        return self.backend.name
+
+    @property
+    def model_version(self) -> str:
+        return self.backend.version
+
+    @property
+    def loaded(self) -> bool:
+        return self.warmup_ms is not None
+
+    def warmup(self, runs: int = 2) -> float:
+        """Run a few dummy batches so lazy allocations happen before traffic."""
+        dummy = np.zeros((1, self.imgsz, self.imgsz, 3), dtype=np.uint8)
+        start = time.perf_counter()
+        for _ in range(runs):
+            self.predict_batch(dummy)
+        self.warmup_ms = (time.perf_counter() - start) * 1000
+        return self.warmup_ms
+
+    def preprocess(self, img: Image.Image) -> np.ndarray:
+        """Letterbox an RGB image to the model input size as a uint8 array."""
+        return letterbox(img, self.imgsz)
+
+    def predict_batch(self, batch) -> list[list[dict]]:
+        """Run one forward pass over a batch of preprocessed images."""
+        batch = np.asarray(batch, dtype=np.uint8)
+        if batch.ndim == 3:
+            batch = batch[None]
+        # Backends are not guaranteed to be re-entrant
+        with self._lock:
+            return self.backend.predict(batch)
+
+
+def letterbox_geometry(width: int, height: int, imgsz: int) -> tuple[int, int, int, int]:
+    """``(new_w, new_h, pad_x, pad_y)`` fitting an image into an ``imgsz`` square.
+
+    The image is scaled to ``new_w x new_h`` with its aspect ratio kept and
+    centred, leaving ``pad_x``/``pad_y`` pixels of padding on the left/top.
+    """
+    r = min(imgsz / width, imgsz / height)
+    new_w, new_h = max(1, round(width * r)), max(1, round(height * r))
+    return new_w, new_h, (imgsz - new_w) // 2, (imgsz - new_h) // 2
+
+
+def letterbox(img: Image.Image, imgsz: int) -> np.ndarray:
+    """Resize keeping the aspect ratio and pad to ``imgsz x imgsz`` RGB uint8."""
+    new_w, new_h, pad_x, pad_y = letterbox_geometry(img.width, img.height, imgsz)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if img.size != (new_w, new_h):
+        img = img.resize((new_w, new_h), Image.BILINEAR)
+    out = np.full((imgsz, imgsz, 3), PAD_VALUE, dtype=np.uint8)
+    out[pad_y:pad_y + new_h, pad_x:pad_x + new_w] = np.asarray(img, dtype=np.uint8)
+    return out
+
+
+def scale_detections(dets: list[dict], sx: float, sy: float,
+                     pad_x: float = 0.0, pad_y: float = 0.0) -> list[dict]:
+    """Map boxes from model input space back to image space.
+
+    ``pad_x``/``pad_y`` are removed before scaling, for letterboxed inputs.
+    """
+    out = []
+    for d in dets:
+        x1, y1, x2, y2 = d["box"]
+        out.append({**d, "box": [round((x1 - pad_x) * sx, 1), round((y1 - pad_y) * sy, 1),
+                                 round((x2 - pad_x) * sx, 1), round((y2 - pad_y) * sy, 1)]})
+    return out
+
+
+def unletterbox(dets: list[dict], width: int, height: int, imgsz: int) -> list[dict]:
+    """Map boxes from a letterboxed model input back to the original image.
+
+    Boxes reaching into the padding are clipped to the image.
+    """
+    new_w, new_h, pad_x, pad_y = letterbox_geometry(width, height, imgsz)
+    out = scale_detections(dets, width / new_w, height / new_h, pad_x, pad_y)
+    for d in out:
+        x1, y1, x2, y2 = d["box"]
+        d["box"] = [min(max(x1, 0.0), width), min(max(y1, 0.0), height),
+                    min(max(x2, 0.0), width), min(max(y2, 0.0), height)]
+    return out
+
+
+def top_prediction(dets: list[dict]) -> dict:
+    """Summarise detections as the single class/confidence /predict returns."""
+    if not dets:
+        return {"class": None, "confidence": 0.0}
+    best = max(dets, key=lambda d: d["confidence"])
+    return {"class": best["name"], "confidence": round(best["confidence"], 4)}
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> InferenceEngine:
+    """Return the process-wide engine, loading and warming it on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = InferenceEngine(
+                    backend=os.getenv("MODEL_BACKEND", "auto"),
+                    model_path=os.getenv("MODEL_PATH") or None,
+                    imgsz=int(os.getenv("MODEL_IMGSZ", "640")),
+                    conf=float(os.getenv("MODEL_CONF", "0.25")),
+                )
+                engine.warmup()
+                _engine = engine
+    return _engine
@@ -0,0 +1,130 @@
+"""Low-memory image ingest.
+
+Uploads are validated from the image header alone (format and pixel count)
+before any pixel data is decoded, so decompression bombs are rejected for the
+cost of reading a few kilobytes. JPEGs are then decoded straight to roughly
+the model input size with libjpeg's DCT scaling (``Image.draft``) instead of
+materialising the full-resolution RGB buffer first. Sizes and decoded pixels
+follow the EXIF orientation, so the model and the boxes use the image as it
+is displayed.
+"""
+import hashlib
+import io
+import os
+import time
+import warnings
+
+from PIL import ExifTags, Image, ImageOps
+
+from inference import letterbox, letterbox_geometry
+
+ALLOWED_FORMATS = ("JPEG", "PNG", "BMP", "WEBP")
+
+# 50 MP covers current phone cameras; anything larger is treated as a bomb
+MAX_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(50_000_000)))
+
+CHUNK = 1 << 16
+
+# EXIF orientations that rotate by 90 degrees, swapping width and height
+_ROTATED = (5, 6, 7, 8)
+
+
+class IngestError(ValueError):
+    """Upload rejected during ingest; ``status`` is the HTTP code to answer with."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+    def __reduce__(self):
+        # Keep the status when raised inside a decode worker process
+        return type(self), (str(self), self.status)
+
+
+def sha256_stream(stream) -> str:
+    """Hash a seekable stream in chunks and rewind it."""
+    h = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(CHUNK), b""):
+        h.update(chunk)
+    stream.seek(0)
+    return h.hexdigest()
+
+
+def open_image(stream, max_pixels: int = MAX_PIXELS) -> Image.Image:
+    """Open an image lazily and validate it from the header only.
+
+    No pixel data is decoded here; the returned image is still backed by
+    ``stream``, which must stay open until it is decoded.
+    """
+    try:
+        with warnings.catch_warnings():
+            # Our own limit below is stricter; don't let Pillow warn first
+            warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+            img = Image.open(stream, formats=ALLOWED_FORMATS)
+    except Image.DecompressionBombError as e:
+        raise IngestError(f"Image too large: {e}", 413)
+    except Image.UnidentifiedImageError:
+        raise IngestError("Unsupported or unrecognised image format", 415)
+    except Exception as e:
+        raise IngestError(f"Invalid image: {e}")
+
+    width, height = img.size
+    if width <= 0 or height <= 0:
+        raise IngestError("Invalid image: empty dimensions")
+    if width * height > max_pixels:
+        raise IngestError(f"Image too large: {width}x{height} exceeds {max_pixels} pixels", 413)
+    return img
+
+
+def _orientation(img: Image.Image) -> int:
+    try:
+        return img.getexif().get(ExifTags.Base.Orientation, 1)
+    except Exception:
+        return 1  # unreadable EXIF is treated as upright
+
+
+def decode_to(img: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """Decode a lazily opened image directly to ``size`` as upright RGB.
+
+    ``size`` is in display orientation (see ``image_info``). For JPEG the
+    draft request makes libjpeg decode at 1/2, 1/4 or 1/8 scale, the smallest
+    that is still at least ``size``; other formats decode at native size and
+    are shrunk with ``reduce`` before the final resample.
+    """
+    rotated = _orientation(img) in _ROTATED
+    try:
+        if img.format == "JPEG":
+            img.draft("RGB", size[::-1] if rotated else size)
+        img.load()
+        img = ImageOps.exif_transpose(img)
+    except Exception as e:
+        raise IngestError(f"Invalid image: {e}")
+
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if img.size != size:
+        img = img.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    return img
+
+
+def image_info(img: Image.Image) -> dict:
+    """Display size (after EXIF orientation) and format, from the header."""
+    width, height = img.size
+    if _orientation(img) in _ROTATED:
+        width, height = height, width
+    return {"width": width, "height": height, "format": img.format}
+
+
+def decode_bytes(data: bytes, size: int) -> dict:
+    """Validate and decode an in-memory upload to a letterboxed ``size x size`` RGB array.
+
+    Top-level so it can run in a decode worker process; returns the header
+    info plus ``array`` and the time spent here as ``decode_s``.
+    """
+    start = time.perf_counter()
+    img = open_image(io.BytesIO(data))
+    info = image_info(img)
+    new_w, new_h, _, _ = letterbox_geometry(info["width"], info["height"], size)
+    x = letterbox(decode_to(img, (new_w, new_h)), size)
+    return {**info, "array": x, "decode_s": time.perf_counter() - start}
@@ -0,0 +1,204 @@
+"""Asynchronous detection jobs.
+
+``POST /jobs`` spools the upload to disk and returns at once; a bounded pool
+of worker threads runs the jobs and clients poll ``GET /jobs/<id>`` or wait
+on the Server-Sent Events stream. Jobs live in this process only, so run the
+API as one process with several threads (or route clients stickily) when
+using this mode.
+"""
+import atexit
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from batching import QueueFull
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class Job:
+    def __init__(self, path: str, options: dict, idempotency_key: str | None = None):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.options = options
+        self.idempotency_key = idempotency_key
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self) -> dict:
+        out = {"job_id": self.id, "status": self.status, "created": self.created,
+               "finished": self.finished}
+        if self.status == DONE:
+            out["result"] = self.result
+        elif self.status == FAILED:
+            out["error"] = self.error
+        return out
+
+
+class JobQueue:
+    def __init__(self, handler, workers: int = 2, max_pending: int = 32,
+                 ttl_s: float = 3600, spool_dir: str | None = None):
+        """``handler(job)`` runs on a worker thread and returns the JSON result.
+
+        It may raise an exception with a ``status`` attribute to fail the job
+        with that HTTP code.
+        """
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.ttl_s = ttl_s
+        # A private temp directory is removed again by stop(), which runs at
+        # interpreter exit; a configured spool_dir is left in place
+        self._owns_spool = spool_dir is None
+        self.spool_dir = spool_dir or tempfile.mkdtemp(prefix="calasense-jobs-")
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._jobs = {}
+        self._by_key = {}
+        self._lock = threading.Lock()
+        self._durations = []
+        self._threads = []
+        self._stopping = threading.Event()
+
+    # --- Lifecycle ---
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._janitor, name="job-janitor", daemon=True)
+        t.start()
+        self._threads.append(t)
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        for _ in range(self.workers):
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass
+        if self._owns_spool:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    # --- Public API ---
+    def submit(self, save, options: dict | None = None,
+               idempotency_key: str | None = None) -> tuple[Job, bool]:
+        """Spool an upload with ``save(path)`` and queue it.
+
+        Returns ``(job, created)``; a repeated idempotency key returns the
+        existing job with ``created=False`` and nothing is spooled. Raises
+        QueueFull when ``max_pending`` jobs are already waiting.
+        """
+        with self._lock:
+            existing = self._lookup(idempotency_key)
+        if existing is not None:
+            return existing, False
+        if self._queue.full():
+            raise QueueFull(f"job queue is full ({self.max_pending} pending)")
+
+        path = os.path.join(self.spool_dir, uuid.uuid4().hex)
+        save(path)
+        job = Job(path, options or {}, idempotency_key)
+        full = False
+        with self._lock:
+            # A concurrent retry with the same key may have won the race
+            existing = self._lookup(idempotency_key)
+            if existing is None:
+                try:
+                    self._queue.put_nowait(job)
+                except queue.Full:
+                    full = True
+                else:
+                    self._jobs[job.id] = job
+                    if idempotency_key:
+                        self._by_key[idempotency_key] = job.id
+        if existing is not None or full:
+            self._remove_file(path)
+        if full:
+            raise QueueFull(f"job queue is full ({self.max_pending} pending)")
+        if existing is not None:
+            return existing, False
+        return job, True
+
+    def _lookup(self, idempotency_key: str | None) -> Job | None:
+        # Caller holds self._lock
+        job_id = self._by_key.get(idempotency_key) if idempotency_key else None
+        return self._jobs.get(job_id) if job_id else None
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def retry_after(self) -> int:
+        """Seconds until a queue slot is likely to free up, for Retry-After."""
+        with self._lock:
+            recent = self._durations[-50:]
+        avg = sum(recent) / len(recent) if recent else 1.0
+        return max(1, round(avg * self._queue.qsize() / self.workers))
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return {"workers": self.workers, "max_pending": self.max_pending,
+                    "queue_depth": self._queue.qsize(), "jobs": counts}
+
+    # --- Workers ---
+    def _work(self):
+        while not self._stopping.is_set():
+            job = self._queue.get()
+            if job is None:
+                break
+            job.status = RUNNING
+            job.started = time.time()
+            try:
+                job.result = self.handler(job)
+                job.status = DONE
+            except Exception as e:
+                status = getattr(e, "status", 504 if isinstance(e, TimeoutError) else 500)
+                job.error = {"error": str(e) or type(e).__name__, "status": status}
+                job.status = FAILED
+            finally:
+                job.finished = time.time()
+                self._remove_file(job.path)
+                with self._lock:
+                    self._durations.append(job.finished - job.started)
+                    del self._durations[:-200]
+                job.done.set()
+
+    def _janitor(self):
+        interval = min(60.0, max(1.0, self.ttl_s / 4))
+        while not self._stopping.wait(interval):
+            self.expire()
+
+    def expire(self, now: float | None = None) -> int:
+        """Drop finished jobs older than the TTL; returns how many were removed."""
+        now = now or time.time()
+        with self._lock:
+            stale = [job for job in self._jobs.values()
+                     if job.finished is not None and job.finished + self.ttl_s <= now]
+            for job in stale:
+                del self._jobs[job.id]
+                if job.idempotency_key and self._by_key.get(job.idempotency_key) == job.id:
+                    del self._by_key[job.idempotency_key]
+        return len(stale)
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
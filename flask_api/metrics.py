@@ -0,0 +1,354 @@
+"""Lightweight request instrumentation.
+
+A small in-process metrics registry rendered in the Prometheus text format,
+per-stage timers that feed both histograms and the per-response
+``Server-Timing`` header / ``meta.timings`` block, and an opt-in sampling
+profiler that can be switched on for a single request with a header.
+"""
+import math
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 5e5, 1e6, 2e6, 5e6, 1e7, 5e7)
+
+
+def _fmt(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    esc = lambda s: str(s).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+
+# --- Registry ---
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class CounterMetric(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in items]
+
+
+class GaugeMetric(CounterMetric):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, *labels):
+        self.inc(-amount, *labels)
+
+
+class CallbackMetric(_Metric):
+    """Gauge or counter whose samples are read from ``fn()`` at scrape time.
+
+    ``fn`` returns a number, or a dict of label-value tuples to numbers.
+    """
+
+    def __init__(self, name, help, fn, labels: tuple = (), kind: str = "gauge"):
+        super().__init__(name, help, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def render(self) -> list[str]:
+        try:
+            samples = self.fn()
+        except Exception:
+            return []
+        if not isinstance(samples, dict):
+            samples = {(): samples}
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}"
+                                for k, v in sorted(samples.items()) if v is not None]
+
+
+class HistogramMetric(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels: tuple = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        lines = self.header()
+        for labels, series in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                le = (("le", _fmt(bound)),)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_fmt(series[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = OrderedDict()
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(CounterMetric(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(GaugeMetric(name, help, labels))
+
+    def callback(self, name, help, fn, labels=(), kind="gauge"):
+        return self._add(CallbackMetric(name, help, fn, labels, kind))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(HistogramMetric(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.counter("calasense_requests_total", "HTTP requests handled",
+                            ("method", "endpoint", "status"))
+REQUEST_SECONDS = registry.histogram("calasense_request_duration_seconds",
+                                     "Time to produce the response (excludes streamed bodies)",
+                                     ("endpoint",))
+STAGE_SECONDS = registry.histogram("calasense_stage_duration_seconds",
+                                   "Time spent in each stage of the request path", ("stage",))
+IN_FLIGHT = registry.gauge("calasense_requests_in_flight", "Requests currently being handled")
+REQUEST_BYTES = registry.histogram("calasense_request_size_bytes", "Request body size",
+                                   ("endpoint",), SIZE_BUCKETS)
+RESPONSE_BYTES = registry.histogram("calasense_response_size_bytes",
+                                    "Response body size (unknown for streamed bodies)",
+                                    ("endpoint",), SIZE_BUCKETS)
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):  # no /proc or os.sysconf
+        return None
+
+
+def _peak_rss_bytes():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+registry.callback("calasense_process_resident_memory_bytes", "Resident set size", _rss_bytes)
+registry.callback("calasense_process_peak_resident_memory_bytes", "Peak resident set size",
+                  _peak_rss_bytes)
+
+
+# --- Stage timing ---
+_local = threading.local()
+
+
+def _current_timings():
+    collected = getattr(_local, "timings", None)
+    if collected is not None:
+        return collected
+    if has_request_context() and "timings" in g:
+        return g.timings
+    return None
+
+
+def record(stage: str, seconds: float):
+    """Record a stage duration in the histogram and in the current timings block."""
+    STAGE_SECONDS.observe(seconds, stage)
+    current = _current_timings()
+    if current is not None:
+        current[stage] = current.get(stage, 0.0) + seconds * 1000
+
+
+@contextmanager
+def collect():
+    """Collect stage timings outside a request (e.g. on a job worker thread)."""
+    _local.timings = {}
+    try:
+        yield
+    finally:
+        _local.timings = None
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def timings() -> dict:
+    """Stage durations (ms) recorded so far in this request or collect() block."""
+    current = _current_timings()
+    return {k: round(v, 2) for k, v in current.items()} if current else {}
+
+
+# --- Sampling profiler ---
+class SamplingProfiler:
+    """Samples one thread's stack on a timer and counts collapsed stacks.
+
+    The output is the folded format used by flamegraph.pl and speedscope:
+    one ``frame;frame;frame count`` line per distinct stack.
+    """
+
+    def __init__(self, thread_id: int, interval_s: float = 0.002):
+        self.thread_id = thread_id
+        self.interval_s = interval_s
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        return "\n".join(f"{stack} {n}" for stack, n in self.stacks.most_common()) + "\n"
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = ";".join(f"{os.path.basename(fs.filename)}:{fs.name}"
+                             for fs in traceback.extract_stack(frame))
+            self.stacks[stack] += 1
+            self.samples += 1
+
+
+class ProfileStore:
+    """Keeps the last few profiles in memory for ``GET /profiles/<id>``."""
+
+    def __init__(self, keep: int = 20):
+        self.keep = keep
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, folded: str) -> str:
+        profile_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            self._profiles[profile_id] = folded
+            while len(self._profiles) > self.keep:
+                self._profiles.popitem(last=False)
+        return profile_id
+
+    def get(self, profile_id: str) -> str | None:
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+
+profiles = ProfileStore()
+
+
+# --- Flask hooks ---
+def init_app(app, profile_token: str | None = None, profile_interval_s: float = 0.002):
+    """Instrument every request of ``app``.
+
+    Profiling is off unless ``profile_token`` is set; a request then opts in
+    with ``X-Profile: <token>`` and the response carries ``X-Profile-Url``.
+    """
+
+    @app.before_request
+    def _start():
+        g.request_start = time.perf_counter()
+        g.timings = {}
+        IN_FLIGHT.inc()
+        g.in_flight = True
+        if request.content_length:
+            REQUEST_BYTES.observe(request.content_length, request.endpoint or "unknown")
+        if profile_token and request.headers.get("X-Profile") == profile_token:
+            g.profiler = SamplingProfiler(threading.get_ident(), profile_interval_s).start()
+
+    @app.after_request
+    def _finish(response):
+        if "request_start" not in g:
+            return response
+        endpoint = request.endpoint or "unknown"
+        total = time.perf_counter() - g.request_start
+        REQUEST_SECONDS.observe(total, endpoint)
+        REQUESTS.inc(1, request.method, endpoint, str(response.status_code))
+        if not response.is_streamed:
+            RESPONSE_BYTES.observe(response.calculate_content_length() or 0, endpoint)
+
+        parts = [f"{stage};dur={ms:.2f}" for stage, ms in g.timings.items()]
+        parts.append(f"total;dur={total * 1000:.2f}")
+        response.headers["Server-Timing"] = ", ".join(parts)
+
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profile_id = profiles.add(profiler.stop())
+            response.headers["X-Profile-Url"] = f"/profiles/{profile_id}"
+        return response
+
+    @app.teardown_request
+    def _teardown(exc):
+        if g.pop("in_flight", False):
+            IN_FLIGHT.dec()
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.stop()
@@ -0,0 +1,219 @@
+"""Annotated-image rendering with a size-bounded disk cache.
+
+``/detect`` registers the original upload and its detection set; nothing is
+drawn until the client GETs the annotated URL. Rendered JPEGs are cached on
+disk per (image hash, detection set, thumbnail size, quality) and evicted
+least-recently-used once the cache exceeds its byte budget.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw, ImageFont
+
+from ingest import decode_to, image_info
+
+# One colour per class id (cycled), chosen to stand out on green leaves
+PALETTE = [(255, 59, 48), (255, 149, 0), (255, 204, 0), (175, 82, 222), (0, 122, 255),
+           (255, 45, 85), (90, 200, 250)]
+
+
+class DiskLRU:
+    """Directory of files bounded by total size, evicting least recently used.
+
+    Recency is tracked in memory (seeded from mtimes at startup) so hits don't
+    rewrite file metadata and Last-Modified stays the creation time. Several
+    worker processes may share the directory: a file another process wrote is
+    found on disk and adopted into this process's index, and each process
+    applies the byte budget to the files it knows about.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # name -> size
+        self._bytes = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        existing = []
+        now = time.time()
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+                # A recent temp file may be another worker's write in progress
+                if name.endswith(".tmp"):
+                    if st.st_mtime + 60 <= now:
+                        os.remove(path)
+                elif os.path.isfile(path):
+                    existing.append((st.st_mtime, name, st.st_size))
+            except OSError:
+                continue
+        for _, name, size in sorted(existing):
+            self._files[name] = size
+            self._bytes += size
+        with self._lock:
+            self._evict()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def get(self, name: str) -> str | None:
+        """Path of a cached file (marking it recently used), or None."""
+        path = self.path(name)
+        with self._lock:
+            if name in self._files:
+                self._files.move_to_end(name)
+                known = True
+            else:
+                known = False
+        if known:
+            return path if os.path.exists(path) else None
+        # Written by another process sharing the directory
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        with self._lock:
+            if name not in self._files:
+                self._files[name] = size
+                self._bytes += size
+                self._evict(keep=name)
+        return path
+
+    def put(self, name: str, write) -> str:
+        """Store a file produced by ``write(tmp_path)`` and return its path."""
+        path = self.path(name)
+        tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        write(tmp)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)  # atomic, so readers never see half a file
+        with self._lock:
+            self._bytes += size - self._files.pop(name, 0)
+            self._files[name] = size
+            self._evict(keep=name)
+        return path
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"files": len(self._files), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes, "evictions": self.evictions}
+
+    def _evict(self, keep: str | None = None):
+        while self._bytes > self.max_bytes and len(self._files) > (1 if keep else 0):
+            name, size = next(iter(self._files.items()))
+            if name == keep:
+                self._files.move_to_end(name)
+                continue
+            del self._files[name]
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                pass
+
+
+def detections_digest(dets: list[dict]) -> str:
+    canonical = json.dumps([[d["class_id"], d["name"], round(d["confidence"], 4), d["box"]] for d in dets],
+                           separators=(",", ":"))
+    return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+
+def draw_detections(img: Image.Image, dets: list[dict], scale: float = 1.0) -> Image.Image:
+    """Draw boxes and ``name confidence`` labels; boxes are in original pixels."""
+    img = img.convert("RGB")
+    draw = ImageDraw.Draw(img)
+    line = max(1, round(min(img.size) / 250))
+    font = ImageFont.load_default(size=max(10, round(min(img.size) / 40)))
+    for d in dets:
+        x1, y1, x2, y2 = (v * scale for v in d["box"])
+        color = PALETTE[d.get("class_id", 0) % len(PALETTE)]
+        draw.rectangle((x1, y1, x2, y2), outline=color, width=line)
+        label = f"{d['name']} {d['confidence']:.2f}"
+        tx1, ty1, tx2, ty2 = draw.textbbox((0, 0), label, font=font)
+        tw, th = tx2 - tx1, ty2 - ty1
+        ty = y1 - th - 2 * line if y1 - th - 2 * line >= 0 else y1
+        draw.rectangle((x1, ty, x1 + tw + 2 * line, ty + th + 2 * line), fill=color)
+        draw.text((x1 + line - tx1, ty + line - ty1), label, fill=(255, 255, 255), font=font)
+    return img
+
+
+class Renderer:
+    def __init__(self, root: str, max_bytes: int = 256 << 20, source_max_bytes: int = 512 << 20):
+        # Sources (uploads + detection sets) and renders are budgeted separately
+        self.sources = DiskLRU(os.path.join(root, "sources"), source_max_bytes)
+        self.rendered = DiskLRU(os.path.join(root, "rendered"), max_bytes)
+
+    def register(self, digest: str, dets: list[dict], copy_source) -> str:
+        """Remember an upload and its detections; returns the annotated image id.
+
+        ``copy_source(path)`` writes the original upload bytes and is only
+        called when this image isn't stored yet.
+        """
+        det_digest = detections_digest(dets)
+        if self.sources.get(digest) is None:
+            self.sources.put(digest, copy_source)
+        name = f"{digest}-{det_digest}.json"
+        if self.sources.get(name) is None:
+            def write(tmp):
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(dets, f)
+            self.sources.put(name, write)
+        return f"{digest}-{det_digest}"
+
+    def get(self, annotated_id: str, width: int | None = None, quality: int = 85) -> str | None:
+        """Path of the rendered JPEG, rendering it on first request.
+
+        ``width`` asks for a thumbnail no wider than that. Returns None when
+        the source image or detection set is no longer stored.
+        """
+        path = self.rendered.get(self._name(annotated_id, width, quality))
+        if path is not None:
+            return path
+
+        digest = annotated_id.split("-", 1)[0]
+        source = self.sources.get(digest)
+        det_path = self.sources.get(f"{annotated_id}.json")
+        if source is None or det_path is None:
+            return None
+
+        with Image.open(source) as img:
+            info = image_info(img)
+            full_w, full_h = info["width"], info["height"]
+            if width and width >= full_w:
+                # Same picture as the full-size render, so share its file
+                width = None
+                path = self.rendered.get(self._name(annotated_id, width, quality))
+                if path is not None:
+                    return path
+            with open(det_path, "r", encoding="utf-8") as f:
+                dets = json.load(f)
+            scale = width / full_w if width else 1.0
+            size = (width, max(1, round(full_h * scale))) if width else (full_w, full_h)
+            # Upright like the boxes, which are in display coordinates
+            annotated = draw_detections(decode_to(img, size), dets, scale)
+
+        return self.rendered.put(self._name(annotated_id, width, quality),
+                                 lambda tmp: annotated.save(tmp, "JPEG", quality=quality, optimize=True))
+
+    @staticmethod
+    def _name(annotated_id: str, width: int | None, quality: int) -> str:
+        return f"{annotated_id}-w{width or 0}-q{quality}.jpg"
+
+    def stats(self) -> dict:
+        return {"sources": self.sources.stats(), "rendered": self.rendered.stats()}
+
+
+def copy_stream(stream):
+    """``copy_source`` callback that copies a seekable upload stream."""
+    def write(path):
+        stream.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(stream, f)
+    return write
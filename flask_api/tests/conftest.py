@@ -0,0 +1,57 @@
+"""Shared fixtures for the API tests.
+
+    cd flask_api
+    pip install -r requirements-dev.txt
+    python -m pytest
+
+The modules import each other as top-level modules (the way ``python app.py``
+runs them), so this directory's parent goes on ``sys.path``. The app module
+is imported once per session with its on-disk state under a temp directory.
+"""
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROFILE_TOKEN = "test-profile-token"
+
+
+def make_image(width: int = 640, height: int = 480, seed: int = 0, fmt: str = "JPEG") -> bytes:
+    """Leaf-green noise with a few dark blotches; distinct per seed."""
+    rng = np.random.default_rng(seed)
+    base = np.zeros((height, width, 3), dtype=np.uint8)
+    base[..., 1] = 150
+    base[..., 0] = 60
+    base = np.clip(base + rng.integers(0, 40, base.shape), 0, 255).astype(np.uint8)
+    for _ in range(4):
+        x, y = rng.integers(0, width - 40), rng.integers(0, height - 40)
+        base[y:y + 40, x:x + 40] = (90, 60, 20)
+    buf = io.BytesIO()
+    Image.fromarray(base).save(buf, fmt)
+    return buf.getvalue()
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    root = tmp_path_factory.mktemp("api")
+    os.environ.update({
+        "RENDER_DIR": str(root / "render"),
+        "JOB_SPOOL_DIR": str(root / "jobs"),
+        "CACHE_DIR": "",
+        "DECODE_WORKERS": "0",
+        "MODEL_BACKEND": "numpy",
+        "PROFILE_TOKEN": PROFILE_TOKEN,
+    })
+    import app
+    app.create_app()
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
@@ -0,0 +1,158 @@
+import io
+import json
+import time
+
+from conftest import PROFILE_TOKEN, make_image
+
+
+def upload(data, name="leaf.jpg", field="image"):
+    return {field: (io.BytesIO(data), name)}
+
+
+def test_health(client):
+    r = client.get("/health")
+    assert r.status_code == 200 and r.get_json()["status"] == "ok"
+
+
+def test_version(client):
+    body = client.get("/version").get_json()
+    assert body["model_loaded"] is True
+    assert body["backend"] == "numpy"
+    assert body["model_version"]
+
+
+def test_stats(client):
+    body = client.get("/stats").get_json()
+    assert {"batching", "cache", "jobs", "render", "decode"} <= set(body)
+
+
+def test_metrics(client):
+    client.get("/health")
+    r = client.get("/metrics")
+    assert r.status_code == 200 and r.mimetype == "text/plain"
+    assert 'calasense_requests_total{method="GET",endpoint="health",status="200"}' in r.get_data(as_text=True)
+
+
+def test_predict(client):
+    r = client.post("/predict", data=upload(make_image(seed=10)))
+    body = r.get_json()
+    assert r.status_code == 200 and body["ok"]
+    assert set(body["prediction"]) == {"class", "confidence"}
+    assert "Server-Timing" in r.headers
+
+
+def test_predict_rejects_bad_uploads(client):
+    assert client.post("/predict", data={}).status_code == 400
+    assert client.post("/predict", data=upload(b"x", "notes.txt")).status_code == 415
+    assert client.post("/predict", data=upload(b"not an image")).status_code == 415
+
+
+def test_detect_then_cache_hit(client):
+    data = make_image(seed=11)
+    first = client.post("/detect", data=upload(data)).get_json()
+    assert first["ok"] and first["annotated_url"].startswith("/annotated/")
+    assert first["meta"]["cache"] == "miss"
+    assert first["meta"]["width"] == 640 and first["meta"]["timings"]
+    again = client.post("/detect", data=upload(data)).get_json()
+    assert again["meta"]["cache"] == "hit"
+    assert again["detections"] == first["detections"]
+
+
+def test_detect_timeout_is_a_json_504(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "INFERENCE_TIMEOUT_S", 0)
+    r = client.post("/detect?tiled=0", data=upload(make_image(seed=12)))
+    assert r.status_code == 504 and "error" in r.get_json()
+
+
+def test_tiled_near_duplicate(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module.cache, "phash", True)
+    data = make_image(2400, 1800, seed=13)
+    first = client.post("/detect", data=upload(data)).get_json()
+    assert first["meta"]["tiles"] > 0
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.open(io.BytesIO(data)).save(buf, "JPEG", quality=80)
+    again = client.post("/detect", data=upload(buf.getvalue())).get_json()
+    assert again["meta"]["cache"] == "near_hit"
+
+
+def test_decode_workers_do_not_fork_the_server(app_module, monkeypatch):
+    from batch import DecodePool
+    from ingest import decode_bytes
+    monkeypatch.setattr(app_module, "DECODE_WORKERS", 1)
+    pool = DecodePool(app_module._new_decode_pool)
+    try:
+        future = pool.submit(decode_bytes, make_image(320, 240), 64)
+        assert future.executor._mp_context.get_start_method() != "fork"
+        assert future.result(timeout=60)["width"] == 320
+    finally:
+        pool.shutdown()
+
+
+def test_detect_batch_streams_ndjson(client):
+    files = [(io.BytesIO(make_image(seed=20 + i)), f"{i}.jpg") for i in range(3)]
+    r = client.post("/detect/batch", data={"images": files})
+    assert r.status_code == 200 and r.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    assert lines[-1] == {"done": True, "count": 3, "ok": 3, "errors": 0}
+    assert sorted(line["index"] for line in lines[:-1]) == [0, 1, 2]
+
+
+def test_batch_and_detect_agree_on_large_images(client):
+    data = make_image(2400, 1800, seed=21)
+    r = client.post("/detect/batch", data={"images": [(io.BytesIO(data), "big.jpg")]})
+    batched = json.loads(r.get_data(as_text=True).splitlines()[0])
+    assert batched["meta"]["tiles"] > 0 and batched["meta"]["cache"] == "miss"
+    single = client.post("/detect", data=upload(data)).get_json()
+    assert single["meta"]["cache"] == "hit"
+    assert single["detections"] == batched["detections"]
+
+
+def test_annotated_image(client):
+    url = client.post("/detect", data=upload(make_image(seed=30))).get_json()["annotated_url"]
+    r = client.get(url)
+    assert r.status_code == 200 and r.mimetype == "image/jpeg"
+    etag = r.headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(url + "?w=100000").headers["ETag"] == etag
+    assert client.get(url + "?w=320").headers["ETag"] != etag
+    assert client.get(url + "?w=abc").status_code == 400
+    assert client.get("/annotated/nope.jpg").status_code == 404
+
+
+def wait_for(client, url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        body = client.get(url).get_json()
+        if body["status"] in ("done", "failed"):
+            return body
+        time.sleep(0.02)
+    raise AssertionError(f"{url} did not finish")
+
+
+def test_jobs(client):
+    data = make_image(seed=40)
+    r = client.post("/jobs", data=upload(data), headers={"Idempotency-Key": "job-40"})
+    assert r.status_code == 202
+    job = r.get_json()
+    assert r.headers["Location"] == job["status_url"]
+    body = wait_for(client, job["status_url"])
+    assert body["status"] == "done" and body["result"]["ok"]
+
+    retry = client.post("/jobs", data=upload(data), headers={"Idempotency-Key": "job-40"})
+    assert retry.status_code == 200 and retry.get_json()["job_id"] == job["job_id"]
+    other = client.post("/jobs", data=upload(make_image(seed=41)), headers={"Idempotency-Key": "job-40"})
+    assert other.status_code == 422
+
+    events = client.get(job["events_url"]).get_data(as_text=True)
+    assert "event: status" in events and "event: done" in events
+    assert client.get("/jobs/unknown").status_code == 404
+    assert client.get("/jobs/unknown/events").status_code == 404
+
+
+def test_profiles(client):
+    r = client.post("/predict", data=upload(make_image(seed=50)), headers={"X-Profile": PROFILE_TOKEN})
+    url = r.headers["X-Profile-Url"]
+    assert client.get(url).status_code == 200
+    assert client.get("/profiles/unknown").status_code == 404
+    assert "X-Profile-Url" not in client.get("/health", headers={"X-Profile": "wrong"}).headers
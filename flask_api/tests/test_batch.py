@@ -0,0 +1,187 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import signal
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from batch import DecodePool, detect_many, iter_archive, iter_multipart
+from batching import MicroBatcher, QueueFull
+from cache import PredictionCache
+from conftest import make_image
+from inference import InferenceEngine
+from ingest import IngestError
+
+ALLOWED = lambda name: name.endswith(".jpg")
+
+
+def read_all(sources):
+    out = []
+    for name, read in sources:
+        try:
+            out.append((name, len(read())))
+        except IngestError as e:
+            out.append((name, e.status))
+    return out
+
+
+def test_multipart_limits():
+    files = [FileStorage(io.BytesIO(b"x" * 10), "a.jpg"),
+             FileStorage(io.BytesIO(b"x" * 11), "big.jpg"),
+             FileStorage(io.BytesIO(b"x"), "notes.txt"),
+             FileStorage(io.BytesIO(b"x"), "c.jpg")]
+    assert read_all(iter_multipart(files, ALLOWED, 3, 10)) == [
+        ("a.jpg", 10), ("big.jpg", 413), ("notes.txt", 415), ("c.jpg", 413)]
+
+
+def test_archive_limits():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("a.jpg", b"x" * 10)
+        z.writestr("big.jpg", b"x" * 11)
+        z.writestr("dir/.hidden.jpg", b"x")
+        z.writestr("notes.txt", b"x")
+    with zipfile.ZipFile(buf) as z:
+        assert read_all(iter_archive(z, ALLOWED, 10, 10)) == [
+            ("a.jpg", 10), ("big.jpg", 413), ("notes.txt", 415)]
+
+
+def _die():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def new_process_pool():
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+
+
+def test_decode_pool_starts_on_first_use():
+    built = []
+    pool = DecodePool(lambda: built.append(1) or ThreadPoolExecutor(max_workers=1))
+    assert built == []
+    try:
+        assert pool.submit(int).result() == 0 and pool.submit(int).result() == 0
+        assert built == [1]
+    finally:
+        pool.shutdown()
+
+
+def test_decode_pool_replaces_a_broken_executor():
+    pool = DecodePool(new_process_pool)
+    try:
+        future = pool.submit(_die)
+        with pytest.raises(BrokenProcessPool):
+            future.result(timeout=30)
+        pool.replace(future.executor)
+        assert pool.submit(int).result(timeout=30) == 0
+        assert pool.restarts == 1
+        # Replacing an executor that was already replaced is a no-op
+        pool.replace(future.executor)
+        assert pool.restarts == 1
+    finally:
+        pool.shutdown()
+
+
+@pytest.fixture
+def pipeline():
+    engine = InferenceEngine(backend="numpy", imgsz=128)
+    batcher = MicroBatcher(engine.predict_batch, max_wait_ms=1).start()
+    pool = DecodePool(lambda: ThreadPoolExecutor(max_workers=2))
+    yield pool, batcher, PredictionCache(engine.model_version)
+    batcher.stop()
+    pool.shutdown()
+
+
+def sources(*items):
+    return [(name, (lambda data=data: data)) for name, data in items]
+
+
+def test_detect_many_yields_one_result_per_image_then_a_summary(pipeline):
+    pool, batcher, cache = pipeline
+    results = list(detect_many(
+        sources(("a.jpg", make_image(320, 240, 1)), ("bad.jpg", b"not an image"),
+                ("b.jpg", make_image(200, 400, 2))),
+        pool, batcher, cache, 128))
+    summary = results.pop()
+    assert summary == {"done": True, "count": 3, "ok": 2, "errors": 1}
+    by_name = {r["filename"]: r for r in results}
+    assert by_name["bad.jpg"]["status"] == 415 and not by_name["bad.jpg"]["ok"]
+    assert by_name["a.jpg"]["meta"]["width"] == 320
+    assert by_name["b.jpg"]["meta"]["height"] == 400
+    for d in by_name["b.jpg"]["detections"]:
+        x1, y1, x2, y2 = d["box"]
+        assert 0 <= x1 <= x2 <= 200 and 0 <= y1 <= y2 <= 400
+
+
+def test_detect_many_answers_repeats_from_the_cache(pipeline):
+    pool, batcher, cache = pipeline
+    data = make_image(320, 240, 3)
+    first = list(detect_many(sources(("a.jpg", data)), pool, batcher, cache, 128))[0]
+    again = list(detect_many(sources(("a.jpg", data)), pool, batcher, cache, 128))[0]
+    assert first["meta"]["cache"] == "miss"
+    assert again["meta"]["cache"] == "hit"
+    assert again["detections"] == first["detections"]
+
+
+class FullQueue:
+    """Batcher stand-in whose queue is full for the first ``busy`` submits."""
+
+    def __init__(self, batcher, busy):
+        self.batcher, self.busy = batcher, busy
+
+    def submit(self, x):
+        if self.busy:
+            self.busy -= 1
+            raise QueueFull("full")
+        return self.batcher.submit(x)
+
+
+def test_detect_many_waits_for_room_in_the_queue(pipeline):
+    pool, batcher, cache = pipeline
+    results = list(detect_many(sources(("a.jpg", make_image(320, 240, 4))), pool,
+                               FullQueue(batcher, busy=3), cache, 128))
+    assert results[0]["ok"] and results[-1]["errors"] == 0
+
+
+def test_detect_many_gives_up_on_a_queue_that_stays_full(pipeline):
+    pool, batcher, cache = pipeline
+    results = list(detect_many(sources(("a.jpg", make_image(320, 240, 5))), pool,
+                               FullQueue(batcher, busy=10**6), cache, 128, timeout=0.2))
+    assert results[0]["status"] == 503
+
+
+class Stalled:
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, fn, *args):
+        self.futures.append(Future())
+        return self.futures[-1]
+
+
+def test_closing_the_stream_cancels_pending_images(pipeline):
+    _, batcher, cache = pipeline
+    stalled = Stalled()
+    results = detect_many(sources(("a.jpg", make_image(320, 240, 6)), ("b.jpg", make_image(320, 240, 7)),
+                                  ("bad.txt", b"not an image")),
+                          DecodePool(lambda: stalled), batcher, cache, 128, use_tiling=lambda info: False)
+    assert next(results)["status"] == 415
+    results.close()  # what the server does when the client disconnects
+    assert len(stalled.futures) == 2 and all(f.cancelled() for f in stalled.futures)
+
+
+def test_detect_many_tiles_large_images(pipeline):
+    pool, batcher, cache = pipeline
+    data = make_image(1600, 1200, 8)
+    first = list(detect_many(sources(("a.jpg", data)), pool, batcher, cache, 128,
+                             use_tiling=lambda info: info["width"] >= 1000, tile=400))[0]
+    assert first["ok"] and first["meta"]["tiles"] > 1
+    for d in first["detections"]:
+        x1, y1, x2, y2 = d["box"]
+        assert 0 <= x1 <= x2 <= 1600 and 0 <= y1 <= y2 <= 1200
+    # The tiled result is cached under the tiled variant, as /detect does
+    assert cache.get(cache.key(hashlib.sha256(data).hexdigest(), "tiled:400:0.2"))["detections"] == first["detections"]
@@ -0,0 +1,140 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from batching import MicroBatcher, QueueFull
+
+X = np.zeros((4, 4, 3), dtype=np.uint8)
+
+
+def recording_predict(calls):
+    def predict(batch):
+        calls.append(len(batch))
+        return [[{"mean": float(x.mean())}] for x in batch]
+    return predict
+
+
+def test_full_batch_flushes_without_waiting_for_the_deadline():
+    calls = []
+    batcher = MicroBatcher(recording_predict(calls), max_batch=4, max_wait_ms=10_000)
+    futures = batcher.submit_many([X] * 4)
+    batcher.start()
+    try:
+        for f in futures:
+            assert f.result(timeout=5) == [{"mean": 0.0}]
+    finally:
+        batcher.stop()
+    assert calls == [4]
+
+
+def test_partial_batch_flushes_at_the_deadline():
+    calls = []
+    batcher = MicroBatcher(recording_predict(calls), max_batch=8, max_wait_ms=20).start()
+    try:
+        future = batcher.submit(X)
+        future.result(timeout=5)
+    finally:
+        batcher.stop()
+    assert calls == [1]
+    assert future.queue_wait_s >= 0.015
+    assert future.forward_s >= 0
+
+
+def test_stop_drains_queued_items():
+    release = threading.Event()
+    calls = []
+
+    def predict(batch):
+        release.wait(5)
+        calls.append(len(batch))
+        return [[] for _ in batch]
+
+    batcher = MicroBatcher(predict, max_batch=1, max_wait_ms=0).start()
+    futures = [batcher.submit(X) for _ in range(3)]
+    stopper = threading.Thread(target=batcher.stop)
+    stopper.start()
+    release.set()
+    stopper.join(5)
+    assert all(f.done() for f in futures)
+    assert calls == [1, 1, 1]
+
+
+def test_queue_full_rejects_and_counts():
+    batcher = MicroBatcher(lambda b: [[] for _ in b], max_queue=2)
+    batcher.submit(X)
+    batcher.submit(X)
+    with pytest.raises(QueueFull):
+        batcher.submit(X)
+    assert batcher.stats()["rejected"] == 1
+    assert batcher.queue_depth == 2
+
+
+def test_submit_many_is_all_or_nothing():
+    batcher = MicroBatcher(lambda b: [[] for _ in b], max_queue=4)
+    batcher.submit(X)
+    with pytest.raises(QueueFull):
+        batcher.submit_many([X] * 4)
+    assert batcher.queue_depth == 1
+    assert len(batcher.submit_many([X] * 3)) == 3
+
+
+def test_concurrent_submit_many_never_overfills():
+    batcher = MicroBatcher(lambda b: [[] for _ in b], max_queue=6)
+    accepted = []
+
+    def producer():
+        try:
+            accepted.append(len(batcher.submit_many([X] * 3)))
+        except QueueFull:
+            pass
+
+    threads = [threading.Thread(target=producer) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(accepted) == batcher.queue_depth == 6
+
+
+def test_cancelled_futures_are_skipped():
+    calls = []
+    batcher = MicroBatcher(recording_predict(calls), max_wait_ms=0)
+    future = batcher.submit(X)
+    assert future.cancel()
+    batcher.start()
+    time.sleep(0.2)
+    batcher.stop()
+    assert calls == []
+
+
+def test_model_errors_fail_the_whole_batch():
+    def predict(batch):
+        raise RuntimeError("boom")
+
+    batcher = MicroBatcher(predict, max_batch=2, max_wait_ms=10_000)
+    futures = batcher.submit_many([X, X])
+    batcher.start()
+    try:
+        for f in futures:
+            with pytest.raises(RuntimeError, match="boom"):
+                f.result(timeout=5)
+    finally:
+        batcher.stop()
+    assert batcher.stats()["failed_batches"] == 1
+
+
+def test_stats_report_batch_sizes():
+    batcher = MicroBatcher(lambda b: [[] for _ in b], max_batch=3, max_wait_ms=10_000)
+    futures = batcher.submit_many([X] * 3)
+    batcher.start()
+    try:
+        for f in futures:
+            f.result(timeout=5)
+    finally:
+        batcher.stop()
+    stats = batcher.stats()
+    assert stats["batch_sizes"] == {"3": 1}
+    assert stats["mean_batch_size"] == 3
+    assert stats["submitted"] == 3
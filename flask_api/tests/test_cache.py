@@ -0,0 +1,158 @@
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.images import encode, leaf
+from cache import PredictionCache, fingerprint, hamming
+
+DETS = [{"name": "canker", "class_id": 2, "confidence": 0.8, "box": [10.0, 20.0, 110.0, 220.0]}]
+
+
+def test_key_depends_on_model_version_and_variant():
+    a, b = PredictionCache("v1"), PredictionCache("v2")
+    assert a.key("d") != b.key("d")
+    assert a.key("d") != a.key("d", "tiled:1280:0.2")
+    assert a.key("d") == PredictionCache("v1").key("d")
+
+
+def test_exact_hit_and_miss():
+    cache = PredictionCache("v1")
+    key = cache.key("digest")
+    assert cache.get(key) is None
+    cache.put(key, DETS, 400, 300)
+    assert cache.get(key)["detections"] == DETS
+    assert cache.stats()["hits"] == 1
+
+
+def test_disabled_cache_stores_nothing():
+    cache = PredictionCache("v1", max_entries=0)
+    cache.put("k", DETS, 400, 300)
+    assert not cache.enabled
+    assert cache.get("k") is None
+
+
+def test_lru_eviction_by_entries():
+    cache = PredictionCache("v1", max_entries=2)
+    cache.put("a", DETS, 1, 1)
+    cache.put("b", DETS, 1, 1)
+    cache.get("a")
+    cache.put("c", DETS, 1, 1)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_eviction_by_bytes():
+    cache = PredictionCache("v1", max_bytes=300)
+    for key in "abcde":
+        cache.put(key, DETS, 1, 1)
+    stats = cache.stats()
+    assert 0 < stats["entries"] < 5
+    assert stats["bytes"] <= 300
+
+
+def test_ttl_expiry():
+    cache = PredictionCache("v1", ttl_s=0.05)
+    cache.put("a", DETS, 1, 1)
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_hamming():
+    hashes = np.array([0, 0b1011, 2**64 - 1], dtype=np.uint64)
+    assert hamming(hashes, 0).tolist() == [0, 3, 64]
+    words = np.array([[0, 0], [1, 2**64 - 1]], dtype=np.uint64)
+    assert hamming(words, [1, 0]).tolist() == [1, 64]
+
+
+def noisy(seed, size=(96, 128)):
+    return np.random.default_rng(seed).integers(0, 255, (*size, 3), dtype=np.uint8)
+
+
+def test_near_duplicates_are_off_by_default():
+    cache = PredictionCache("v1")
+    cache.put("a", DETS, 400, 300, fingerprint(noisy(0)))
+    assert cache.get_similar(fingerprint(noisy(0)), 400, 300) is None
+
+
+def test_near_duplicate_is_rescaled():
+    cache = PredictionCache("v1", phash=True)
+    h = fingerprint(noisy(0))
+    cache.put("a", DETS, 400, 300, h)
+    hit = cache.get_similar(h, 800, 600)
+    assert hit["detections"][0]["box"] == [20.0, 40.0, 220.0, 440.0]
+    assert (hit["width"], hit["height"]) == (800, 600)
+    assert cache.stats()["near_hits"] == 1
+
+
+def test_near_duplicate_requires_same_aspect_and_variant():
+    cache = PredictionCache("v1", phash=True)
+    h = fingerprint(noisy(0))
+    cache.put("a", DETS, 400, 300, h, variant="tiled")
+    assert cache.get_similar(h, 400, 300) is None
+    assert cache.get_similar(h, 400, 400, "tiled") is None
+    assert cache.get_similar(h, 400, 300, "tiled") is not None
+
+
+def test_unrelated_images_are_not_near_duplicates():
+    cache = PredictionCache("v1", phash=True)
+    cache.put("a", DETS, 400, 300, fingerprint(noisy(0)))
+    assert cache.get_similar(fingerprint(noisy(1)), 400, 300) is None
+
+
+def decoded(data):
+    return Image.open(io.BytesIO(data)).convert("RGB").resize((640, 480), Image.BILINEAR)
+
+
+def test_leaves_with_the_same_framing_are_not_near_duplicates():
+    # Their hashes are close; the thumbnails tell them apart
+    cache = PredictionCache("v1", phash=True)
+    first, other = leaf(1280, 960, 2), leaf(1280, 960, 8)
+    cache.put("a", DETS, 1280, 960, fingerprint(decoded(encode(first, "JPEG"))))
+    assert cache.get_similar(fingerprint(decoded(encode(other, "JPEG"))), 1280, 960) is None
+    # A re-encoded, downsized copy of the same leaf still matches
+    copy = encode(first.resize((640, 480)), "JPEG", quality=60)
+    assert cache.get_similar(fingerprint(decoded(copy)), 640, 480) is not None
+
+
+def test_evicted_entries_leave_the_phash_index():
+    cache = PredictionCache("v1", max_entries=1, phash=True)
+    h = fingerprint(noisy(0))
+    cache.put("a", DETS, 400, 300, h)
+    cache.put("b", DETS, 400, 300, fingerprint(noisy(1)))
+    assert cache.get_similar(h, 400, 300) is None
+    assert cache.get_similar(fingerprint(noisy(1)), 400, 300) is not None
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    PredictionCache("v1", disk_dir=str(tmp_path)).put("a" * 64, DETS, 400, 300)
+    cache = PredictionCache("v1", disk_dir=str(tmp_path))
+    assert cache.get("a" * 64)["detections"] == DETS
+    assert cache.stats()["disk_hits"] == 1
+    # A different model version has its own directory
+    assert PredictionCache("v2", disk_dir=str(tmp_path)).get("a" * 64) is None
+
+
+def disk_files(root):
+    return [os.path.join(d, f) for d, _, files in os.walk(root) for f in files]
+
+
+def test_disk_tier_is_bounded(tmp_path):
+    cache = PredictionCache("v1", disk_dir=str(tmp_path), disk_max_bytes=2000)
+    for i in range(50):
+        cache.put(f"{i:064x}", DETS, 400, 300)
+    assert sum(os.path.getsize(p) for p in disk_files(tmp_path)) <= 2000
+    assert cache.stats()["disk_evictions"] > 0
+    # The newest entry is kept
+    assert os.path.exists(cache._disk_path(f"{49:064x}"))
+
+
+def test_sweep_removes_expired_files(tmp_path):
+    cache = PredictionCache("v1", disk_dir=str(tmp_path), ttl_s=60)
+    cache.put("a" * 64, DETS, 400, 300)
+    assert cache.sweep_disk(now=time.time() + 120) == 1
+    assert disk_files(tmp_path) == []
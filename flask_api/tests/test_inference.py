@@ -0,0 +1,63 @@
+import numpy as np
+from PIL import Image
+
+from inference import (PAD_VALUE, InferenceEngine, letterbox, letterbox_geometry, scale_detections,
+                       top_prediction, unletterbox)
+
+
+def det(box, confidence=0.5, name="canker"):
+    return {"name": name, "class_id": 2, "confidence": confidence, "box": box}
+
+
+def test_letterbox_geometry_keeps_the_aspect_ratio():
+    assert letterbox_geometry(4032, 3024, 640) == (640, 480, 0, 80)
+    assert letterbox_geometry(300, 600, 640) == (320, 640, 160, 0)
+    assert letterbox_geometry(640, 640, 640) == (640, 640, 0, 0)
+
+
+def test_letterbox_pads_around_the_image():
+    img = Image.new("RGB", (400, 300), (10, 200, 30))
+    x = letterbox(img, 64)
+    assert x.shape == (64, 64, 3) and x.dtype == np.uint8
+    assert (x[0, 0] == PAD_VALUE).all() and (x[-1, -1] == PAD_VALUE).all()
+    assert x[32, 32].tolist() == [10, 200, 30]
+
+
+def test_unletterbox_maps_boxes_back_and_clips():
+    # 4032x3024 -> 640x480 content with 80px bars at top and bottom
+    dets = unletterbox([det([0, 80, 320, 560]), det([-10, 0, 10, 640])], 4032, 3024, 640)
+    assert dets[0]["box"] == [0.0, 0.0, 2016.0, 3024.0]
+    assert dets[1]["box"] == [0.0, 0.0, 63.0, 3024.0]
+
+
+def test_scale_detections():
+    assert scale_detections([det([1, 2, 3, 4])], 2, 10)[0]["box"] == [2, 20, 6, 40]
+    assert scale_detections([det([11, 12, 13, 14])], 2, 10, 10, 10)[0]["box"] == [2, 20, 6, 40]
+
+
+def test_top_prediction():
+    assert top_prediction([]) == {"class": None, "confidence": 0.0}
+    best = top_prediction([det([0, 0, 1, 1], 0.3, "greening"), det([0, 0, 1, 1], 0.91234, "canker")])
+    assert best == {"class": "canker", "confidence": 0.9123}
+
+
+def test_reference_backend_is_deterministic():
+    engine = InferenceEngine(backend="numpy", imgsz=128)
+    rng = np.random.default_rng(0)
+    batch = rng.integers(0, 255, (2, 128, 128, 3), dtype=np.uint8)
+    first = engine.predict_batch(batch)
+    assert first == InferenceEngine(backend="numpy", imgsz=128).predict_batch(batch)
+    assert len(first) == 2
+    # A single image is accepted without a batch axis
+    assert engine.predict_batch(batch[0]) == first[:1]
+    for d in first[0]:
+        x1, y1, x2, y2 = d["box"]
+        assert 0 <= x1 < x2 <= 128 and 0 <= y1 < y2 <= 128
+
+
+def test_warmup_marks_the_engine_loaded():
+    engine = InferenceEngine(backend="numpy", imgsz=64)
+    assert not engine.loaded
+    engine.warmup(runs=1)
+    assert engine.loaded and engine.warmup_ms >= 0
+    assert engine.model_version == "numpy-ref-seed0"
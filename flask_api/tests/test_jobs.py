@@ -0,0 +1,104 @@
+import os
+import threading
+
+import pytest
+
+from batching import QueueFull
+from jobs import DONE, FAILED, QUEUED, JobQueue
+
+
+def save(path):
+    with open(path, "wb") as f:
+        f.write(b"upload")
+
+
+class Boom(Exception):
+    status = 422
+
+
+def test_runs_jobs_and_removes_the_spool_file(tmp_path):
+    queue = JobQueue(lambda job: {"ok": True, "options": job.options},
+                     spool_dir=str(tmp_path)).start()
+    try:
+        job, created = queue.submit(save, {"a": 1})
+        assert created
+        assert job.done.wait(5)
+        assert job.status == DONE
+        assert job.to_dict()["result"] == {"ok": True, "options": {"a": 1}}
+        assert os.listdir(tmp_path) == []
+    finally:
+        queue.stop()
+
+
+def test_failures_carry_the_exception_status(tmp_path):
+    def handler(job):
+        if job.options["kind"] == "boom":
+            raise Boom("bad input")
+        raise TimeoutError()
+
+    queue = JobQueue(handler, spool_dir=str(tmp_path)).start()
+    try:
+        boom, _ = queue.submit(save, {"kind": "boom"})
+        slow, _ = queue.submit(save, {"kind": "timeout"})
+        assert boom.done.wait(5) and slow.done.wait(5)
+        assert boom.status == FAILED
+        assert boom.to_dict()["error"] == {"error": "bad input", "status": 422}
+        assert slow.error["status"] == 504
+    finally:
+        queue.stop()
+
+
+def test_idempotency_key_returns_the_same_job(tmp_path):
+    queue = JobQueue(lambda job: {}, spool_dir=str(tmp_path))
+    first, created = queue.submit(save, idempotency_key="k")
+    second, created_again = queue.submit(save, idempotency_key="k")
+    assert created and not created_again
+    assert second is first
+    assert len(os.listdir(tmp_path)) == 1
+    assert queue.submit(save, idempotency_key="other")[0] is not first
+
+
+def test_concurrent_retries_create_one_job(tmp_path):
+    queue = JobQueue(lambda job: {}, spool_dir=str(tmp_path))
+    jobs = []
+    threads = [threading.Thread(target=lambda: jobs.append(queue.submit(save, idempotency_key="k")[0]))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len({job.id for job in jobs}) == 1
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_queue_full(tmp_path):
+    queue = JobQueue(lambda job: {}, max_pending=1, spool_dir=str(tmp_path))
+    job, _ = queue.submit(save)
+    assert job.status == QUEUED
+    with pytest.raises(QueueFull):
+        queue.submit(save)
+    assert len(os.listdir(tmp_path)) == 1
+    assert queue.retry_after() >= 1
+
+
+def test_expire_drops_old_jobs_and_frees_their_key(tmp_path):
+    queue = JobQueue(lambda job: {}, ttl_s=60, spool_dir=str(tmp_path)).start()
+    try:
+        job, _ = queue.submit(save, idempotency_key="k")
+        assert job.done.wait(5)
+        assert queue.expire(now=job.finished + 30) == 0
+        assert queue.expire(now=job.finished + 60) == 1
+        assert queue.get(job.id) is None
+        again, created = queue.submit(save, idempotency_key="k")
+        assert created and again.id != job.id
+    finally:
+        queue.stop()
+
+
+def test_stop_removes_only_its_own_spool_dir(tmp_path):
+    owned = JobQueue(lambda job: {})
+    owned.stop()
+    assert not os.path.exists(owned.spool_dir)
+    configured = JobQueue(lambda job: {}, spool_dir=str(tmp_path))
+    configured.stop()
+    assert os.path.isdir(tmp_path)
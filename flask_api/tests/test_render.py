@@ -0,0 +1,141 @@
+import io
+import os
+import time
+
+from PIL import Image
+
+from conftest import make_image
+from inference import PAD_VALUE
+from ingest import decode_bytes, decode_to, image_info, open_image
+from render import DiskLRU, Renderer, detections_digest
+
+DETS = [{"name": "canker", "class_id": 2, "confidence": 0.8, "box": [10.0, 20.0, 110.0, 220.0]}]
+
+
+def write_bytes(n):
+    def write(path):
+        with open(path, "wb") as f:
+            f.write(b"x" * n)
+    return write
+
+
+def test_disk_lru_evicts_least_recently_used(tmp_path):
+    lru = DiskLRU(str(tmp_path), max_bytes=25)
+    lru.put("a", write_bytes(10))
+    lru.put("b", write_bytes(10))
+    assert lru.get("a") is not None
+    lru.put("c", write_bytes(10))
+    assert lru.get("b") is None
+    assert not os.path.exists(tmp_path / "b")
+    assert lru.get("a") is not None and lru.get("c") is not None
+    assert lru.stats()["evictions"] == 1
+
+
+def test_disk_lru_keeps_a_file_larger_than_the_budget(tmp_path):
+    lru = DiskLRU(str(tmp_path), max_bytes=5)
+    lru.put("big", write_bytes(10))
+    assert lru.get("big") is not None
+
+
+def test_disk_lru_reloads_existing_files(tmp_path):
+    DiskLRU(str(tmp_path), max_bytes=100).put("a", write_bytes(10))
+    lru = DiskLRU(str(tmp_path), max_bytes=100)
+    assert lru.get("a") is not None
+    assert lru.stats()["bytes"] == 10
+
+
+def test_disk_lru_finds_files_written_by_another_process(tmp_path):
+    first, second = DiskLRU(str(tmp_path), 100), DiskLRU(str(tmp_path), 100)
+    first.put("a", write_bytes(10))
+    assert second.get("a") == str(tmp_path / "a")
+    assert second.stats()["files"] == 1
+    assert second.get("missing") is None
+
+
+def test_disk_lru_only_removes_stale_temp_files(tmp_path):
+    fresh, stale = tmp_path / "a.1-2.tmp", tmp_path / "b.1-2.tmp"
+    fresh.write_bytes(b"x")
+    stale.write_bytes(b"x")
+    old = time.time() - 3600
+    os.utime(stale, (old, old))
+    DiskLRU(str(tmp_path), 100)
+    assert fresh.exists() and not stale.exists()
+
+
+def test_detections_digest_is_stable():
+    assert detections_digest(DETS) == detections_digest([dict(DETS[0])])
+    assert detections_digest(DETS) != detections_digest([])
+
+
+def register(renderer, data, digest="a" * 64):
+    def copy(path):
+        with open(path, "wb") as f:
+            f.write(data)
+    return renderer.register(digest, DETS, copy)
+
+
+def test_renders_full_size_and_thumbnails(tmp_path):
+    renderer = Renderer(str(tmp_path))
+    annotated_id = register(renderer, make_image(800, 600))
+    full = renderer.get(annotated_id)
+    with Image.open(full) as img:
+        assert img.size == (800, 600) and img.format == "JPEG"
+    with Image.open(renderer.get(annotated_id, width=200)) as img:
+        assert img.size == (200, 150)
+    assert renderer.get(annotated_id) == full
+
+
+def test_width_at_or_above_full_size_shares_the_full_render(tmp_path):
+    renderer = Renderer(str(tmp_path))
+    annotated_id = register(renderer, make_image(800, 600))
+    full = renderer.get(annotated_id)
+    assert renderer.get(annotated_id, width=800) == full
+    assert renderer.get(annotated_id, width=5000) == full
+    assert renderer.stats()["rendered"]["files"] == 1
+
+
+def test_another_renderer_on_the_same_root_can_serve(tmp_path):
+    annotated_id = register(Renderer(str(tmp_path)), make_image(800, 600))
+    assert Renderer(str(tmp_path)).get(annotated_id) is not None
+
+
+def test_unknown_image_is_none(tmp_path):
+    assert Renderer(str(tmp_path)).get("b" * 64 + "-" + "0" * 16) is None
+
+
+def rotated_jpeg(width=400, height=300):
+    """Stored ``width x height`` with a red top-left corner, EXIF-rotated 90 degrees clockwise."""
+    img = Image.new("RGB", (width, height), (40, 160, 40))
+    img.paste((255, 0, 0), (0, 0, 40, 40))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", exif=exif)
+    return buf.getvalue()
+
+
+def test_ingest_follows_exif_orientation():
+    img = open_image(io.BytesIO(rotated_jpeg()))
+    assert image_info(img)["width"] == 300 and image_info(img)["height"] == 400
+    upright = decode_to(img, (150, 200))
+    assert upright.size == (150, 200)
+    # Orientation 6 turns the stored top-left corner into the top-right one
+    r, g, _ = upright.getpixel((145, 5))
+    assert r > 200 and g < 80
+
+
+def test_decode_bytes_letterboxes_the_upright_image():
+    decoded = decode_bytes(rotated_jpeg(), 64)
+    assert (decoded["width"], decoded["height"]) == (300, 400)
+    # Portrait content, so the bars are at the sides
+    x = decoded["array"]
+    assert (x[32, 2] == PAD_VALUE).all() and not (x[32, 32] == PAD_VALUE).all()
+
+
+def test_renders_upright(tmp_path):
+    renderer = Renderer(str(tmp_path))
+    annotated_id = register(renderer, rotated_jpeg())
+    with Image.open(renderer.get(annotated_id)) as img:
+        assert img.size == (300, 400)
+    with Image.open(renderer.get(annotated_id, width=150)) as img:
+        assert img.size == (150, 200)
@@ -0,0 +1,143 @@
+import io
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import make_image
+from inference import letterbox_geometry
+from tiling import box_iou, detect_tiled, nms, tile_grid, tile_views
+
+
+def resolved(results):
+    futures = []
+    for r in results:
+        f = Future()
+        f.set_result(r)
+        futures.append(f)
+    return futures
+
+
+def test_tile_grid_covers_the_image_and_ends_at_the_edge():
+    corners = tile_grid(1000, 640, 640, 128)
+    assert corners.tolist() == [[0, 0], [360, 0]]
+    corners = tile_grid(2000, 1500, 640, 128)
+    xs, ys = sorted(set(corners[:, 0])), sorted(set(corners[:, 1]))
+    assert xs[0] == 0 and xs[-1] == 2000 - 640
+    assert ys[0] == 0 and ys[-1] == 1500 - 640
+    assert all(b - a <= 640 - 128 for a, b in zip(xs, xs[1:]))
+
+
+def test_tile_grid_single_tile_for_small_images():
+    assert tile_grid(300, 200, 640, 128).tolist() == [[0, 0]]
+
+
+def test_box_iou():
+    a = np.array([[0, 0, 10, 10]], dtype=float)
+    b = np.array([[0, 0, 10, 10], [5, 0, 15, 10], [20, 20, 30, 30]], dtype=float)
+    assert box_iou(a, b)[0].tolist() == pytest.approx([1.0, 50 / 150, 0.0])
+
+
+def test_nms_keeps_the_best_of_overlapping_boxes():
+    boxes = np.array([[0, 0, 10, 10], [1, 1, 11, 11], [50, 50, 60, 60]], dtype=float)
+    scores = np.array([0.6, 0.9, 0.5])
+    assert nms(boxes, scores, iou_threshold=0.5).tolist() == [1, 2]
+
+
+def test_nms_is_class_aware():
+    boxes = np.array([[0, 0, 10, 10], [1, 1, 11, 11]], dtype=float)
+    scores = np.array([0.6, 0.9])
+    assert sorted(nms(boxes, scores, np.array([0, 1])).tolist()) == [0, 1]
+
+
+def test_nms_blocks_match_a_single_pass():
+    rng = np.random.default_rng(0)
+    xy = rng.uniform(0, 500, (300, 2))
+    boxes = np.hstack([xy, xy + rng.uniform(10, 80, (300, 2))])
+    scores, classes = rng.uniform(0, 1, 300), rng.integers(0, 3, 300)
+    whole = nms(boxes, scores, classes, block=300)
+    assert 0 < len(whole) < 300
+    assert nms(boxes, scores, classes, block=7).tolist() == whole.tolist()
+
+
+def test_nms_empty():
+    assert nms(np.empty((0, 4)), np.empty(0)).tolist() == []
+
+
+def open_lazy(data):
+    return Image.open(io.BytesIO(data))
+
+
+def test_tile_views_shapes():
+    views = tile_views(open_lazy(make_image(2400, 1800)), 2400, 1800, 640, tile=1280, overlap=0.2)
+    assert views["work_size"] == (1200, 900)
+    assert len(views["crops"]) == len(views["corners"]) == 6
+    assert all(c.shape == (640, 640, 3) for c in views["crops"])
+    assert views["full_view"].shape == (640, 640, 3)
+
+
+def test_full_view_boxes_map_back_through_the_letterbox():
+    width, height = 2400, 1800
+    views = tile_views(open_lazy(make_image(width, height)), width, height, 640)
+    new_w, new_h, pad_x, pad_y = letterbox_geometry(*views["work_size"], 640)
+    whole = {"name": "canker", "class_id": 2, "confidence": 0.9,
+             "box": [pad_x, pad_y, pad_x + new_w, pad_y + new_h]}
+
+    def submit(xs):
+        return resolved([[] for _ in xs[:-1]] + [[whole]])
+
+    dets = detect_tiled(views, width, height, 640, submit)
+    assert [d["box"] for d in dets] == [[0.0, 0.0, width, height]]
+
+
+def test_tile_boxes_are_offset_and_clipped():
+    width, height = 2400, 1800
+    views = tile_views(open_lazy(make_image(width, height)), width, height, 640)
+    box = {"name": "canker", "class_id": 2, "confidence": 0.9, "box": [600, 600, 700, 700]}
+
+    def submit(xs):
+        return resolved([[box] if i == len(xs) - 2 else [] for i in range(len(xs))])
+
+    dets = detect_tiled(views, width, height, 640, submit)
+    x1, y1, x2, y2 = dets[0]["box"]
+    assert (x2, y2) == (width, height)
+    assert x1 < width and y1 < height
+
+
+def test_views_are_submitted_in_chunks():
+    views = tile_views(open_lazy(make_image(2400, 1800)), 2400, 1800, 640)
+    sizes = []
+
+    def submit(xs):
+        sizes.append(len(xs))
+        return resolved([[] for _ in xs])
+
+    detect_tiled(views, 2400, 1800, 640, submit, chunk=2)
+    assert sizes == [2, 2, 2, 1]
+
+
+def test_timeout_cancels_pending_views():
+    views = tile_views(open_lazy(make_image(2400, 1800)), 2400, 1800, 640)
+    futures = []
+
+    def submit(xs):
+        futures.extend(Future() for _ in xs)
+        return futures
+
+    with pytest.raises(TimeoutError):
+        detect_tiled(views, 2400, 1800, 640, submit, timeout=0.01)
+    assert all(f.cancelled() for f in futures)
+
+
+def test_only_the_best_boxes_of_each_view_are_merged():
+    width, height = 2400, 1800
+    views = tile_views(open_lazy(make_image(width, height)), width, height, 640)
+    many = [{"name": "canker", "class_id": 2, "confidence": i / 100, "box": [i * 5, 0, i * 5 + 4, 4]}
+            for i in range(1, 50)]
+
+    def submit(xs):
+        return resolved([many if i == 0 else [] for i in range(len(xs))])
+
+    dets = detect_tiled(views, width, height, 640, submit, max_per_view=3)
+    assert [d["confidence"] for d in dets] == [0.49, 0.48, 0.47]
@@ -0,0 +1,180 @@
+"""Tiled high-resolution inference.
+
+Small lesions vanish when a 12 MP frame is squashed to one model input, so
+large images are also cut into overlapping tiles that are each seen at model
+resolution. The image is decoded at the scale where one tile is exactly
+``imgsz`` pixels (JPEG draft decoding gets most of the way there), so tiles
+need no per-tile resize. All tiles plus one letterboxed full-frame view go
+through the scheduler together (in chunks when there are more views than the
+queue holds), and the boxes are merged with a vectorised NMS.
+"""
+import io
+import math
+import time
+from concurrent.futures import wait
+
+import numpy as np
+from PIL import Image
+
+from inference import PAD_VALUE, letterbox, letterbox_geometry
+from ingest import decode_to, image_info, open_image
+
+
+def tiled_variant(tile: int, overlap: float) -> str:
+    """Cache variant for results of tiled inference with these settings."""
+    return f"tiled:{tile}:{overlap}"
+
+
+def tile_grid(width: int, height: int, tile: int, overlap: int) -> np.ndarray:
+    """Top-left corners of overlapping ``tile``-sized windows covering the image.
+
+    The last row/column is aligned to the far edge instead of running past it.
+    """
+    def starts(size):
+        if size <= tile:
+            return np.zeros(1, dtype=np.int64)
+        stride = max(1, tile - overlap)
+        n = math.ceil((size - tile) / stride) + 1
+        return np.minimum(np.arange(n) * stride, size - tile)
+
+    xs, ys = starts(width), starts(height)
+    gx, gy = np.meshgrid(xs, ys)
+    return np.stack([gx.ravel(), gy.ravel()], axis=1)
+
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Pairwise IoU between (N, 4) and (M, 4) xyxy boxes."""
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    wh = np.clip(rb - lt, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def nms(boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray | None = None,
+        iou_threshold: float = 0.5, block: int = 256) -> np.ndarray:
+    """Class-aware non-maximum suppression without per-box Python loops.
+
+    Uses the matrix form of NMS (as in YOLACT's Fast NMS): a box is dropped if
+    any higher-scoring box of the same class overlaps it above the threshold.
+    Unlike greedy NMS, an already-suppressed box can still suppress others, so
+    it is marginally more aggressive. Each class is compared on its own, in
+    float32 blocks of ``block`` rows, so memory stays at ``block x N`` rather
+    than ``N x N`` however many boxes the tiles produce. Returns indices of
+    kept boxes by descending score.
+    """
+    if len(boxes) == 0:
+        return np.empty(0, dtype=np.int64)
+    boxes = np.asarray(boxes, dtype=np.float32)
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    if classes is None:
+        groups = [order]
+    else:
+        ordered = np.asarray(classes)[order]
+        groups = [order[ordered == c] for c in np.unique(ordered)]
+
+    keep = np.zeros(len(boxes), dtype=bool)
+    for idx in groups:
+        b = boxes[idx]
+        worst = np.zeros(len(idx), dtype=np.float32)  # highest IoU with a better-scoring box
+        for start in range(0, len(idx), block):
+            # Rows only suppress the columns after them, i.e. lower scores
+            iou = np.triu(box_iou(b[start:start + block], b[start:]), k=1)
+            np.maximum(worst[start:], iou.max(axis=0), out=worst[start:])
+        keep[idx[worst <= iou_threshold]] = True
+    return order[keep[order]]
+
+
+def tile_views(img, width: int, height: int, imgsz: int, tile: int = 1280,
+               overlap: float = 0.2) -> dict:
+    """Decode a lazily opened image and cut it into model inputs.
+
+    ``tile`` is in original image pixels and ``overlap`` is a fraction of a
+    tile. Returns ``crops`` (``imgsz x imgsz`` RGB arrays), their ``corners``
+    in working pixels, the letterboxed ``full_view``, the unpadded working
+    image as ``content`` and its ``work_size``.
+    """
+    scale = min(1.0, imgsz / tile)
+    work_w, work_h = max(1, round(width * scale)), max(1, round(height * scale))
+    work = content = np.asarray(decode_to(img, (work_w, work_h)))
+    full_view = letterbox(Image.fromarray(work), imgsz)
+    if work_w < imgsz or work_h < imgsz:
+        # Pad a thin side up to one tile rather than stretching it
+        padded = np.full((max(imgsz, work_h), max(imgsz, work_w), 3), PAD_VALUE, dtype=np.uint8)
+        padded[:work_h, :work_w] = work
+        work = padded
+    step_overlap = int(round(imgsz * overlap))
+    corners = tile_grid(work.shape[1], work.shape[0], imgsz, step_overlap)
+    crops = [work[y:y + imgsz, x:x + imgsz] for x, y in corners]
+    return {"crops": crops, "corners": corners, "full_view": full_view,
+            "content": content, "work_size": (work_w, work_h)}
+
+
+def decode_tiles(data: bytes, imgsz: int, tile: int = 1280, overlap: float = 0.2) -> dict:
+    """``tile_views`` of an in-memory upload, plus its header info and ``decode_s``.
+
+    Top-level so it can run in a decode worker process, like
+    ``ingest.decode_bytes``.
+    """
+    start = time.perf_counter()
+    img = open_image(io.BytesIO(data))
+    info = image_info(img)
+    views = tile_views(img, info["width"], info["height"], imgsz, tile, overlap)
+    return {**info, "views": views, "decode_s": time.perf_counter() - start}
+
+
+def _run_views(views: list, submit, timeout: float | None, chunk: int | None) -> list:
+    # Chunks run one after another so an image can have more views than the
+    # scheduler queue holds; all of them share one deadline
+    chunk = max(1, chunk or len(views))
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    results = []
+    for i in range(0, len(views), chunk):
+        futures = submit(views[i:i + chunk])
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        _, not_done = wait(futures, timeout=remaining)
+        if not_done:
+            for f in not_done:
+                f.cancel()
+            raise TimeoutError(f"{len(not_done)} of {len(views)} views did not finish in time")
+        results.extend(f.result() for f in futures)
+    return results
+
+
+def detect_tiled(views: dict, width: int, height: int, imgsz: int, submit,
+                 iou_threshold: float = 0.5, timeout: float | None = None,
+                 chunk: int | None = None, max_per_view: int = 100) -> list[dict]:
+    """Run detection on the output of ``tile_views`` and merge the boxes.
+
+    ``submit`` takes a list of model inputs and returns one future per input
+    (``MicroBatcher.submit_many``); at most ``chunk`` are submitted at once.
+    Only the ``max_per_view`` best boxes of each view are merged. Returned
+    boxes are in original image pixels.
+    """
+    crops, corners, full_view = views["crops"], views["corners"], views["full_view"]
+    work_w, work_h = views["work_size"]
+    results = _run_views(crops + [full_view], submit, timeout, chunk)
+    results = [sorted(r, key=lambda d: -d["confidence"])[:max_per_view] for r in results]
+
+    flat = [d for r in results for d in r]
+    if not flat:
+        return []
+
+    # Per view: origin in working pixels and scale back to image pixels. The
+    # full-frame view is last; its origin undoes the letterbox padding.
+    new_w, new_h, pad_x, pad_y = letterbox_geometry(work_w, work_h, imgsz)
+    origins = np.vstack([corners, [[-pad_x, -pad_y]]]).astype(np.float64)
+    scales = np.tile([width / work_w, height / work_h], (len(results), 1))
+    scales[-1] = (width / new_w, height / new_h)
+    owner = np.repeat(np.arange(len(results)), [len(r) for r in results])
+
+    raw = np.array([d["box"] for d in flat], dtype=np.float64)
+    boxes = (raw + np.tile(origins[owner], 2)) * np.tile(scales[owner], 2)
+    boxes = np.clip(boxes, 0, [width, height, width, height])
+    scores = np.array([d["confidence"] for d in flat])
+    classes = np.array([d["class_id"] for d in flat])
+
+    keep = nms(boxes, scores, classes, iou_threshold)
+    return [{**flat[i], "box": np.round(boxes[i], 1).tolist()} for i in keep]